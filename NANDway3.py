@@ -15,21 +15,371 @@
 # see file COPYING or http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt
 # *************************************************************************
 
+import os
+import io
+import mmap
 import time
 import datetime
 import sys
+import queue
+import hashlib
+import threading
+import select
+import json
+import zlib
+import gzip
+import lzma
+import shutil
+import bisect
+import struct
+import concurrent.futures
+from collections import deque, OrderedDict
+from contextlib import contextmanager, ExitStack
 import serial
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+VERSION_MAJOR = 0
+VERSION_MINOR = 65
+
 
 class TeensySerialError(Exception):
     "Exception class for errors when communicating with the Teensy."
 
 
+class TraceRecorder:
+    """
+    Records every byte sent to and received from the device in a trace
+    file, for ReplaySerial to play back later. TeensySerial feeds it from
+    the same writev()/readv() paths a normal run uses, so a captured run
+    talks to the port exactly like one that is not captured.
+    The trace is TRACE_MAGIC followed by records of a direction byte
+    (HOST or DEVICE), the time since the capture started as a double and
+    the data length, then the data.
+    """
+    TRACE_MAGIC = b"NWTRACE1"
+    RECORD = struct.Struct("<BdI")
+    HOST = 0
+    DEVICE = 1
+
+    def __init__(self, filename: str):
+        self.trace = open(filename, "wb")  # pylint: disable=consider-using-with
+        try:
+            self.trace.write(self.TRACE_MAGIC)
+        except BaseException:
+            self.trace.close()
+            raise
+        self.start = time.perf_counter()
+
+    def record(self, direction: int, data):
+        "Add data sent in direction to the trace."
+        if len(data):
+            self.trace.write(self.RECORD.pack(
+                direction, time.perf_counter() - self.start, memoryview(data).nbytes))
+            self.trace.write(data)
+
+    def record_views(self, views: list, count: int):
+        "Add the first count bytes received into the buffers in views."
+        for view in views:
+            if count <= 0:
+                break
+            self.record(self.DEVICE, view[:count])
+            count -= len(view)
+
+    def close(self):
+        "Finish the trace."
+        self.trace.close()
+
+
+class ReplaySerial:
+    """
+    Stands in for a serial port, answering from a trace written by
+    TraceRecorder. What the host sends is checked against the trace and a
+    TeensySerialError is raised as soon as it differs. Reads are served
+    at full speed, or with timing at the times they arrived during the
+    capture.
+    """
+    fd = None
+    timeout = 0
+    is_open = True
+
+    def __init__(self, filename: str, timing: bool = False):
+        with open(filename, "rb") as tracefile:
+            trace = tracefile.read()
+        if not trace.startswith(TraceRecorder.TRACE_MAGIC):
+            raise TeensySerialError(f"{filename} is not a NANDway trace")
+
+        host = []
+        device = []
+        # offset in the device stream where each record starts, and its time
+        self.offsets = []
+        self.times = []
+        pos = len(TraceRecorder.TRACE_MAGIC)
+        device_size = 0
+        while pos < len(trace):
+            direction, timestamp, size = TraceRecorder.RECORD.unpack_from(trace, pos)
+            pos += TraceRecorder.RECORD.size
+            data = trace[pos:pos+size]
+            pos += size
+            if direction == TraceRecorder.HOST:
+                host.append(data)
+            else:
+                device.append(data)
+                self.offsets.append(device_size)
+                self.times.append(timestamp)
+                device_size += size
+
+        self.host = b"".join(host)
+        self.device = b"".join(device)
+        self.host_pos = 0
+        self.device_pos = 0
+        self.timing = timing
+        self.start = None
+
+    def write(self, data):
+        "Check data against what the host sent during the capture."
+        if self.start is None:
+            self.start = time.perf_counter()
+        if not self.host.startswith(data, self.host_pos):
+            raise TeensySerialError(
+                f"Replay diverged from the trace at host byte {self.host_pos}")
+        self.host_pos += len(data)
+        return len(data)
+
+    def read(self, size: int):
+        "Return the next bytes the device sent during the capture."
+        if self.start is None:
+            self.start = time.perf_counter()
+        data = self.device[self.device_pos:self.device_pos+size]
+        self.device_pos += len(data)
+        if self.timing and data:
+            record = bisect.bisect_right(self.offsets, self.device_pos - 1) - 1
+            delay = self.start + self.times[record] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def flush(self):
+        "Nothing to flush."
+
+    def reset_input_buffer(self):
+        "Nothing to reset."
+
+    def reset_output_buffer(self):
+        "Nothing to reset."
+
+    def close(self):
+        "Stop answering."
+        self.is_open = False
+
+
+class OutputQueue:
+    """
+    Scatter-gather queue of data waiting to be sent to the Teensy.
+    Small writes such as command and address bytes are collected in a
+    bytearray, while read-only payloads of at least ZEROCOPY_MIN bytes are
+    queued by reference, so page data reaches the port without first
+    being copied into a buffer. A payload queued by reference must not
+    change until the queue has been sent: only read-only buffers are
+    queued that way, but a read-only view of a writable object (such as
+    memoryview.toreadonly()) would still see the object change, so
+    callers must not reuse such a buffer before the next flush.
+    """
+    ZEROCOPY_MIN = 256
+
+    def __init__(self):
+        self.chunks: deque = deque()
+        self.tail: bytearray = bytearray()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value: int):
+        "Queue a single byte."
+        self.tail.append(value)
+        self.size += 1
+
+    def extend(self, data: bytes):
+        "Queue a bytes-like object, by reference if it is large and read-only."
+        view = memoryview(data).cast("B")
+        if view.readonly and view.nbytes >= self.ZEROCOPY_MIN:
+            if self.tail:
+                self.chunks.append(self.tail)
+                self.tail = bytearray()
+            self.chunks.append(view)
+        else:
+            self.tail.extend(view)
+        self.size += view.nbytes
+
+    def take(self):
+        "Remove everything from the queue and return it as a list of buffers."
+        if self.tail:
+            self.chunks.append(self.tail)
+            self.tail = bytearray()
+        chunks = list(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        return chunks
+
+
+class BufferPool:
+    """
+    Fixed set of preallocated buffers that are handed out and given back,
+    so the same memory is reused for every page instead of allocating a
+    new bytes object each time. get() blocks while every buffer is in use.
+    """
+
+    def __init__(self, size: int, count: int):
+        self.size = size
+        self.free: queue.Queue = queue.Queue()
+        for _ in range(count):
+            self.free.put(bytearray(size))
+
+    def get(self):
+        "Take a buffer from the pool."
+        return self.free.get()
+
+    def put(self, buf: bytearray):
+        "Give a buffer back to the pool."
+        self.free.put(buf)
+
+
+def prometheus_label(value) -> str:
+    "Escape a label value for the Prometheus text format."
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Instrumentation for one Teensy link: a latency histogram per command,
+    bytes on the wire in each direction, counts of the status bytes
+    received and of retried transfers.
+    Latency is measured from sending a command to collecting its response,
+    so with pipelining it includes the time spent behind earlier commands.
+    """
+    # histogram bucket bounds in seconds, powers of two from 16us to 8s
+    BUCKETS = tuple(2**n / 1e6 for n in range(4, 24))
+    STATUS_NAMES = {75: "K", 84: "T", 82: "R", 86: "V", 80: "P"}
+
+    def __init__(self):
+        self.latency = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = {}
+        self.retries = {}
+
+    def observe(self, command: str, seconds: float):
+        "Record the latency of one command."
+        hist = self.latency.get(command)
+        if hist is None:
+            hist = self.latency[command] = {
+                "buckets": [0] * (len(self.BUCKETS) + 1), "sum": 0.0, "count": 0}
+        hist["buckets"][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        hist["sum"] += seconds
+        hist["count"] += 1
+
+    def count_status(self, res: int):
+        "Record a status byte received from the Teensy."
+        name = self.STATUS_NAMES.get(res, f"0x{res:02x}")
+        self.statuses[name] = self.statuses.get(name, 0) + 1
+
+    def count_retry(self, operation: str):
+        "Record that an operation had to be retried."
+        self.retries[operation] = self.retries.get(operation, 0) + 1
+
+    def as_dict(self):
+        "The metrics as a JSON-friendly dict."
+        return {
+            "bucket_bounds": list(self.BUCKETS),
+            "latency": self.latency,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "statuses": self.statuses,
+            "retries": self.retries,
+        }
+
+    def write_json(self, filename: str):
+        "Write the metrics to filename as JSON."
+        with open(filename, "w", encoding="utf-8") as metricsfile:
+            json.dump(self.as_dict(), metricsfile, indent=2)
+
+    def write_prometheus(self, filename: str, labels: dict = None):
+        """
+        Write the metrics in the Prometheus text format, for the node
+        exporter's textfile collector. labels are added to every sample.
+        The file is replaced atomically so the collector never sees half
+        of it.
+        """
+        base = "".join(f',{name}="{prometheus_label(value)}"'
+                       for name, value in (labels or {}).items())
+        lines = [
+            "# HELP nandway_command_seconds Time from sending a command to its response.",
+            "# TYPE nandway_command_seconds histogram",
+        ]
+        for command, hist in sorted(self.latency.items()):
+            tags = f'command="{command}"{base}'
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (float("inf"),), hist["buckets"]):
+                cumulative += count
+                bound = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'nandway_command_seconds_bucket{{{tags},le="{bound}"}} {cumulative}')
+            lines.append(f"nandway_command_seconds_sum{{{tags}}} {hist['sum']!r}")
+            lines.append(f"nandway_command_seconds_count{{{tags}}} {hist['count']}")
+
+        lines += [
+            "# HELP nandway_bytes_total Bytes transferred over the serial link.",
+            "# TYPE nandway_bytes_total counter",
+            f'nandway_bytes_total{{direction="sent"{base}}} {self.bytes_sent}',
+            f'nandway_bytes_total{{direction="received"{base}}} {self.bytes_received}',
+            "# HELP nandway_status_total Status bytes received from the Teensy.",
+            "# TYPE nandway_status_total counter",
+        ]
+        lines += [f'nandway_status_total{{status="{name}"{base}}} {count}'
+                  for name, count in sorted(self.statuses.items())]
+        lines += [
+            "# HELP nandway_retries_total Operations that had to be retried.",
+            "# TYPE nandway_retries_total counter",
+        ]
+        lines += [f'nandway_retries_total{{operation="{name}"{base}}} {count}'
+                  for name, count in sorted(self.retries.items())]
+
+        temp_path = filename + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as promfile:
+            promfile.write("\n".join(lines) + "\n")
+        os.replace(temp_path, filename)
+
+
 class TeensySerial:
     "Class for communicating with a Teensy running NANDWay firmware."
     BUFSIZE = 32768
 
-    def __init__(self, port: str):
+    # os.writev() takes at most this many buffers per call
+    WRITEV_MAX = 512
+
+    def __init__(self, port: str, transport=None, capture: str = ""):
+        """
+        Open the serial port, or use transport in its place (e.g. a
+        ReplaySerial). With capture, the link is recorded to that trace file.
+        """
+        self.obuf: OutputQueue = OutputQueue()
+        # bytes read from the port ahead of time, served before the port
+        self.ibuf: bytearray = bytearray()
+        self.status: bytearray = bytearray(1)
+        self.metrics: Metrics = Metrics()
+        self.trace: TraceRecorder = TraceRecorder(capture) if capture else None
+        self.ser = transport
+        if not port or transport is not None:
+            return
+
         try:
             self.ser = serial.Serial(
                 port,
@@ -40,37 +390,170 @@ class TeensySerial:
                 xonxoff=False,
                 write_timeout=120)
         except serial.SerialException as exc:
+            if self.trace:
+                self.trace.close()
             raise TeensySerialError(f"could not open serial {port}") from exc
         self.ser.reset_input_buffer()
         self.ser.reset_output_buffer()
-        self.obuf: bytearray = bytearray()
 
     def write(self, write_data: int | bytes):
         """
         Add data to the output buffer.
         If data overflows buffer, it will be flushed to the device. (FIFO)
+        Large read-only payloads are referenced rather than copied, so
+        they must stay alive until the next flush.
         """
         if isinstance(write_data, int):
             self.obuf.append(write_data)
         else:
             self.obuf.extend(write_data)
-        while len(self.obuf) > self.BUFSIZE:
-            self.ser.write(self.obuf[:self.BUFSIZE])
-            self.obuf = self.obuf[self.BUFSIZE:]
+        if len(self.obuf) > self.BUFSIZE:
+            self._send()
+
+    def _send(self):
+        """
+        Hand everything in the output buffer to the serial port, with one
+        writev() where the port has a file descriptor, and otherwise (as on
+        Windows) one write() per queued buffer, so payloads are not copied.
+        """
+        self.metrics.bytes_sent += len(self.obuf)
+        chunks = self.obuf.take()
+        if self.trace:
+            for chunk in chunks:
+                self.trace.record(TraceRecorder.HOST, chunk)
+        fd = getattr(self.ser, "fd", None)
+        if fd is None or not hasattr(os, "writev"):
+            for chunk in chunks:
+                self.ser.write(chunk)
+            return
+
+        while chunks:
+            batch = chunks[:self.WRITEV_MAX]
+            try:
+                written = os.writev(fd, batch)
+            except BlockingIOError:
+                written = 0
+            while batch and written >= memoryview(batch[0]).nbytes:
+                written -= memoryview(batch[0]).nbytes
+                batch.pop(0)
+                chunks.pop(0)
+            if written:
+                chunks[0] = memoryview(chunks[0])[written:]
+            if batch:
+                # the port is busy, let pyserial wait for it
+                self.metrics.count_retry("write")
+                self.ser.write(chunks.pop(0))
 
     def flush(self):
         "Flush the output buffer to the device."
         if len(self.obuf):
-            self.ser.write(self.obuf)
+            self._send()
             self.ser.flush()
-            self.obuf.clear()
 
     def read(self, size: int):
         "Read data from the serial device."
         self.flush()
+        if self.ibuf:
+            read_data = bytes(self.ibuf[:size])
+            del self.ibuf[:size]
+            if len(read_data) < size:
+                more = self.ser.read(size - len(read_data))
+                self.metrics.bytes_received += len(more)
+                if self.trace:
+                    self.trace.record(TraceRecorder.DEVICE, more)
+                read_data += more
+            return read_data
         read_data = self.ser.read(size)
+        self.metrics.bytes_received += len(read_data)
+        if self.trace:
+            self.trace.record(TraceRecorder.DEVICE, read_data)
         return read_data
 
+    def _read_some_into(self, views: list):
+        """
+        Read at least one byte into the buffers in views, filling them in
+        order with whatever the port has ready, in a single readv() where
+        the port has a file descriptor.
+        Returns the number of bytes read, 0 on timeout.
+        """
+        if self.ibuf:
+            got = 0
+            for view in views:
+                count = min(len(view), len(self.ibuf))
+                view[:count] = self.ibuf[:count]
+                del self.ibuf[:count]
+                got += count
+                if not self.ibuf:
+                    break
+            return got
+
+        fd = getattr(self.ser, "fd", None)
+        if fd is None or not hasattr(os, "readv"):
+            read_data = self.ser.read(len(views[0]))
+            views[0][:len(read_data)] = read_data
+            self.metrics.bytes_received += len(read_data)
+            if self.trace:
+                self.trace.record(TraceRecorder.DEVICE, read_data)
+            return len(read_data)
+
+        while True:
+            ready, _, _ = select.select([fd], [], [], self.ser.timeout)
+            if not ready:
+                return 0
+            try:
+                count = os.readv(fd, views)
+            except BlockingIOError:
+                self.metrics.count_retry("read")
+                continue
+            if count == 0:
+                raise TeensySerialError("device disconnected while reading")
+            self.metrics.bytes_received += count
+            if self.trace:
+                self.trace.record_views(views, count)
+            return count
+
+    def readinto(self, buf):
+        """
+        Read len(buf) bytes from the serial device into buf, without
+        allocating a new bytes object.
+        Returns the number of bytes read, which is short only on timeout.
+        """
+        self.flush()
+        view = memoryview(buf)
+        got = 0
+        while got < len(view):
+            count = self._read_some_into([view[got:]])
+            if count == 0:
+                break
+            got += count
+        return got
+
+    def read_status_into(self, buf, ok: int = 75):
+        """
+        Read a status byte and, if it is ok ('K'), a payload filling buf.
+        Both are requested from the port in one read; anything read past
+        a failed status belongs to the next response and is kept in ibuf.
+        Returns the status byte.
+        """
+        self.flush()
+        views = [memoryview(self.status), memoryview(buf)]
+        got = self._read_some_into(views)
+        if got == 0:
+            raise TeensySerialError("Timed out waiting for the Teensy")
+
+        if self.status[0] != ok:
+            if got > 1:
+                self.ibuf[:0] = views[1][:got-1]
+            return self.status[0]
+
+        got -= 1
+        while got < len(buf):
+            count = self._read_some_into([views[1][got:]])
+            if count == 0:
+                raise TeensySerialError("Timed out waiting for the Teensy")
+            got += count
+        return self.status[0]
+
     def readbyte(self):
         "Read one byte from the serial device."
         return self.read(1)[0]
@@ -80,6 +563,8 @@ class TeensySerial:
         print()
         print("Closing serial device...")
         self.ser.close()
+        if self.trace:
+            self.trace.close()
         print("Done.")
 
 
@@ -103,7 +588,7 @@ class NANDFlasher(TeensySerial):
     nand_bus_width: int = 0
     nand_plane_count: int = 0
     nand_plane_size: int = 0
-
+    free_ram: int = 0
     # Teensy commands
     CMD_PING1 = 0
     CMD_PING2 = 1
@@ -121,6 +606,21 @@ class NANDFlasher(TeensySerial):
     CMD_NAND1_WRITEPAGE = 13
     CMD_NAND1_ERASEBLOCK = 14
 
+    # Number of page reads kept in flight by readpages()
+    READ_WINDOW = 8
+
+    # Number of pages buffered between the serial link and the disk in dump()
+    DUMP_QUEUE_DEPTH = 256
+
+    # Teensy RAM left to the firmware when sizing the write window,
+    # and the most WRITEPAGE frames ever queued ahead
+    WRITE_RAM_RESERVE = 1024
+    WRITE_WINDOW_MAX = 16
+    # Times blocks that fail a deferred verify are rewritten before giving up
+    VERIFY_RETRIES = 2
+    # Bytes of written blocks program_stream() holds for each deferred verify
+    STREAM_VERIFY_BYTES = 32 << 20
+
     # NAND names
     NAND_NAMES = {
         0xEC: {  # Samsung
@@ -144,21 +644,25 @@ class NANDFlasher(TeensySerial):
         }
     }
 
-    def __init__(self, port: str, nand_id: int, ver_major: int, ver_minor: int):
-        if port:
-            super().__init__(port)
+    def __init__(self, port: str, nand_id: int, ver_major: int, ver_minor: int,
+                 transport=None, capture: str = ""):
+        super().__init__(port, transport, capture)
         self.nand_id = nand_id & 1
         self.nand_disable_pullups = nand_id & 10
         self.version_major = ver_major
         self.version_minor = ver_minor
+        self.pools = {}
+        self.progress = Progress()
 
     def ping(self):
         "Ping the Teensy and check the firmware version."
+        start = time.perf_counter()
         self.write(self.CMD_PING1)
         self.write(self.CMD_PING2)
         ver_major = self.readbyte()
         ver_minor = self.readbyte()
         free_ram = (self.readbyte() << 8) | self.readbyte()
+        self.metrics.observe("ping", time.perf_counter() - start)
         if (ver_major != self.version_major) or (ver_minor != self.version_minor):
             print(
                 "Ping failed",
@@ -168,10 +672,12 @@ class NANDFlasher(TeensySerial):
             self.close()
             sys.exit(1)
 
+        self.free_ram = free_ram
         return free_ram
 
     def readid(self):
         "Read the manufacturer and device IDs from the device."
+        start = time.perf_counter()
         if self.nand_disable_pullups == 0:
             self.write(self.CMD_PULLUPS_ENABLE)
         else:
@@ -190,6 +696,7 @@ class NANDFlasher(TeensySerial):
             sys.exit(1)
 
         nand_info = self.read(25)
+        self.metrics.observe("readid", time.perf_counter() - start)
 
         print("Raw ID info:",
               ' '.join(f"0x{byte:02x}" for byte in nand_info[0:5])
@@ -281,14 +788,24 @@ class NANDFlasher(TeensySerial):
         Bus width:              {self.nand_bus_width}-bit
         """)
 
+    def report_progress(self, done: int, total: int):
+        """
+        Show how many bytes of an operation are done, through self.progress.
+        Subclasses can override this to send progress elsewhere.
+        """
+        self.progress.update(done, total, self.nand_page_size_plus_ras)
+
     def bootloader(self):
         self.write(self.CMD_BOOTLOADER)
         self.flush()
 
     def read_result(self):
         # read status byte
-        res = self.readbyte()
+        return self.check_result(self.readbyte())
 
+    def check_result(self, res: int):
+        "Check a status byte received from the Teensy."
+        self.metrics.count_status(res)
         # 'K' = okay, 'T' = timeout error when writing, 'R' = Teensy receive buffer timeout, 'V' = Verification error
         error_msg = ""
 
@@ -314,6 +831,7 @@ class NANDFlasher(TeensySerial):
 
     def erase_block(self, page: int):
         "Erase a NAND block."
+        start = time.perf_counter()
         if self.nand_id == 1:
             self.write(self.CMD_NAND1_ERASEBLOCK)
         else:
@@ -326,14 +844,16 @@ class NANDFlasher(TeensySerial):
         self.write((page >> 8) & 0xFF)
         self.write((page >> 16) & 0xFF)
 
-        if self.read_result() == 0:
+        result = self.read_result()
+        self.metrics.observe("erase_block", time.perf_counter() - start)
+        if result == 0:
             print(f"Block {page_block} - error erasing block")
             return 0
 
         return 1
 
-    def readpage(self, page: int):
-        "Read data from a NAND page."
+    def _send_readpage(self, page: int):
+        "Queue a page read command without waiting for its result."
         if (self.nand_id == 1):
             self.write(self.CMD_NAND1_READPAGE)
         else:
@@ -346,6 +866,8 @@ class NANDFlasher(TeensySerial):
         self.write((page >> 8) & 0xFF)
         self.write((page >> 16) & 0xFF)
 
+    def _recv_page(self, page: int):
+        "Collect the result of a previously queued page read."
         read_error_code = self.read_result()
         if read_error_code == 0:
             raise NANDError(f"Error while reading page {page}")
@@ -353,12 +875,138 @@ class NANDFlasher(TeensySerial):
             data = self.read(self.nand_page_size_plus_ras)
             return data
 
-    def writepage(self, page_data: bytes, page_number: int):
-        "Write data to a NAND page."
-        if len(page_data) != self.nand_page_size_plus_ras:
-            print(f"Incorrent data size {len(page_data)}")
-            return -1
+    def _recv_page_into(self, page: int, buf):
+        "Collect the result of a previously queued page read into buf."
+        if self.check_result(self.read_status_into(buf)) == 0:
+            raise NANDError(f"Error while reading page {page}")
+        return buf
 
+    def readpage(self, page: int):
+        "Read data from a NAND page."
+        start = time.perf_counter()
+        self._send_readpage(page)
+        data = self._recv_page(page)
+        self.metrics.observe("readpage", time.perf_counter() - start)
+        return data
+
+    def readpage_into(self, page: int, buf):
+        """
+        Read a NAND page into buf, which must be nand_page_size_plus_ras
+        bytes long. The status byte and the page are read together.
+        """
+        start = time.perf_counter()
+        self._send_readpage(page)
+        self._recv_page_into(page, buf)
+        self.metrics.observe("readpage", time.perf_counter() - start)
+        return buf
+
+    def readpages(self, pages, window: int = READ_WINDOW, pool=None):
+        """
+        Read a sequence of NAND pages, keeping up to `window` read commands
+        in flight instead of waiting for each page before requesting the next.
+        Yields (page, data) tuples in the order the pages were requested.
+        With a BufferPool, each page is read into a buffer taken from the
+        pool, which the caller hands back with pool.put() when done with it.
+        """
+        reads = self.pipelined_reads(((self, page) for page in pages), window, pool)
+        try:
+            for _, page, data in reads:
+                yield page, data
+        finally:
+            reads.close()
+
+    def page_pool(self, count: int):
+        """
+        A BufferPool of count page-sized buffers, kept and reused by later
+        calls asking for the same number.
+        """
+        key = (self.nand_page_size_plus_ras, count)
+        if key not in self.pools:
+            self.pools[key] = BufferPool(self.nand_page_size_plus_ras, count)
+        return self.pools[key]
+
+    @staticmethod
+    def pipelined_reads(requests, window: int, pool=None):
+        """
+        Read pages for a sequence of (flasher, page) requests, keeping up to
+        `window` READPAGE commands in flight. The flashers must share one
+        Teensy, e.g. a NANDFlasher and its companion().
+        Yields (flasher, page, data) tuples in request order, where data is
+        a buffer from pool if one is given. If a page read fails, the reads
+        still in flight are drained before the NANDError is raised, so the
+        stream stays in sync.
+        """
+        window = max(1, window)
+        requests = iter(requests)
+        in_flight = deque()
+        try:
+            while True:
+                while len(in_flight) < window:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    request[0]._send_readpage(request[1])
+                    in_flight.append((request[0], request[1], time.perf_counter()))
+
+                if not in_flight:
+                    return
+
+                flasher, page, start = in_flight.popleft()
+                try:
+                    if pool is None:
+                        data = flasher._recv_page(page)
+                    else:
+                        buf = pool.get()
+                        try:
+                            data = flasher._recv_page_into(page, buf)
+                        except BaseException:
+                            # NANDError, a serial timeout or an interrupt:
+                            # the buffer never reaches the caller
+                            pool.put(buf)
+                            raise
+                except NANDError:
+                    # keep the stream in sync for whoever talks to the device next
+                    NANDFlasher.drain_reads(in_flight)
+                    raise
+                flasher.metrics.observe("readpage", time.perf_counter() - start)
+                yield flasher, page, data
+        except GeneratorExit:
+            NANDFlasher.drain_reads(in_flight)
+            raise
+
+    @staticmethod
+    def drain_reads(in_flight: deque):
+        "Consume the responses to (flasher, page, start) reads that are still in flight."
+        while in_flight:
+            flasher = in_flight.popleft()[0]
+            if not getattr(flasher.ser, "is_open", True):
+                # check_result() closed the port on a fatal status, there
+                # is nothing left to keep in sync
+                in_flight.clear()
+                return
+            res = flasher.readbyte()
+            flasher.metrics.count_status(res)
+            if res == 75:  # 'K'
+                flasher.read(flasher.nand_page_size_plus_ras)
+
+    def companion(self):
+        """
+        Create a NANDFlasher for the other NAND on the same Teensy,
+        sharing this one's serial connection and output buffer.
+        """
+        other = NANDFlasher(None, (self.nand_id ^ 1) | self.nand_disable_pullups,
+                            self.version_major, self.version_minor)
+        other.ser = self.ser
+        other.obuf = self.obuf
+        other.ibuf = self.ibuf
+        other.free_ram = self.free_ram
+        other.progress = self.progress
+        other.metrics = self.metrics
+        other.trace = self.trace
+        return other
+
+    def _send_writepage(self, page_data: bytes, page_number: int):
+        "Queue a page write command without waiting for its result."
         if (self.nand_id == 1):
             self.write(self.CMD_NAND1_WRITEPAGE)
         else:
@@ -373,13 +1021,109 @@ class NANDFlasher(TeensySerial):
 
         self.write(page_data)
 
-        if self.read_result() == 0:
+    def writepage(self, page_data: bytes, page_number: int):
+        "Write data to a NAND page."
+        if len(page_data) != self.nand_page_size_plus_ras:
+            print(f"Incorrent data size {len(page_data)}")
+            return -1
+
+        start = time.perf_counter()
+        self._send_writepage(page_data, page_number)
+        result = self.read_result()
+        self.metrics.observe("writepage", time.perf_counter() - start)
+        if result == 0:
             return 0
 
         return 1
 
-    def dump(self, filename: str, block_offset: int, nblocks: int):
-        "Dump data from the NAND to a file."
+    def write_window(self):
+        """
+        Number of WRITEPAGE frames that can be queued ahead of their status,
+        sized from the free RAM the Teensy reported in ping().
+        """
+        frame_size = 4 + self.nand_page_size_plus_ras
+        window = 1 + max(0, self.free_ram - self.WRITE_RAM_RESERVE) // frame_size
+        return min(window, self.WRITE_WINDOW_MAX)
+
+    def writepages(self, pages, window: int = 0):
+        """
+        Write a sequence of (page_number, page_data) pairs, keeping up to
+        `window` WRITEPAGE frames in flight while the statuses come back.
+        A window of 0 sizes it with write_window().
+        Returns the list of page numbers that failed to program.
+        """
+        if window <= 0:
+            window = self.write_window()
+
+        failed = []
+        in_flight = deque()
+        for page_number, page_data in pages:
+            if len(page_data) != self.nand_page_size_plus_ras:
+                print(f"Incorrent data size {len(page_data)}")
+                failed.append(page_number)
+                continue
+
+            self._send_writepage(page_data, page_number)
+            in_flight.append((page_number, time.perf_counter()))
+
+            if len(in_flight) >= window:
+                self._collect_write(in_flight, failed)
+
+        while in_flight:
+            self._collect_write(in_flight, failed)
+
+        return failed
+
+    def _collect_write(self, in_flight: deque, failed: list):
+        "Match the next write status to the oldest page still in flight."
+        page_number, start = in_flight.popleft()
+        result = self.read_result()
+        self.metrics.observe("writepage", time.perf_counter() - start)
+        if result == 0:
+            print(f"Page 0x{page_number:x} - error writing page")
+            failed.append(page_number)
+
+    def chip_state(self):
+        "Describe the chip: its ID and geometry."
+        return {
+            "mf_id": self.mf_id,
+            "device_id": self.device_id,
+            "page_size": self.nand_page_size,
+            "ras": self.nand_ras,
+            "pages_per_block": self.nand_pages_per_block,
+            "block_count": self.nand_block_count,
+        }
+
+    def journal_state(self, operation: str, block_offset: int, nblocks: int,
+                      image: str = ""):
+        "Describe the chip, the range and the image an operation covers, for a Journal."
+        return dict(self.chip_state(), operation=operation, block_offset=block_offset,
+                    nblocks=nblocks, image=image)
+
+    def dump(self, filename: str, block_offset: int, nblocks: int,
+             window: int = READ_WINDOW, hashes: tuple = (),
+             journal: str = "", resume: bool = False, ecc: "EccChecker" = None,
+             consistency: "ConsistencyCheck" = None):
+        """
+        Dump data from the NAND to a file.
+        Pages are read into pooled buffers and handed to a writer thread
+        through a bounded queue, so a slow disk does not hold up the serial
+        link. Any hashlib algorithms
+        named in hashes are computed over the dump as it is written, and
+        their hex digests are returned as a dict.
+        If a journal path is given, progress is recorded there, and with
+        resume the dump continues from the last block the journal saw
+        written.
+        With an EccChecker, the ECC of the pages dumped in this run is
+        checked as they are written; call its finish() for the results.
+        A filename ending in CONTAINER_SUFFIX is written as an image
+        container (see ContainerWriter), without a journal.
+        With a ConsistencyCheck, the pages dumped in this run are checked
+        for bad reads, and pages that read differently are read again and
+        patched in the file once they settle (see settle_pages()). This
+        needs a plain file, and "ecc" mode uses ecc or a default
+        EccChecker.
+        """
 
         if nblocks == 0:
             nblocks = self.nand_block_count
@@ -387,56 +1131,440 @@ class NANDFlasher(TeensySerial):
         if nblocks > self.nand_block_count:
             nblocks = self.nand_block_count
 
+        container = filename.endswith(CONTAINER_SUFFIX)
+        if consistency and container:
+            raise ValueError("A consistency check cannot patch an image container")
+        if consistency and consistency.mode == "ecc" and ecc is None:
+            ecc = EccChecker(self.nand_page_size, self.nand_ras)
+        if container:
+            # a container is only usable once its index is written, so it
+            # cannot be resumed
+            journal = ""
+
+        start_block = block_offset
+        if journal:
+            journal = Journal(journal, self.journal_state("dump", block_offset, nblocks))
+            if resume:
+                start_block = journal.resume()
+
+        first_page = block_offset*self.nand_pages_per_block
+        last_page = (block_offset+nblocks)*self.nand_pages_per_block
+        resume_offset = (start_block-block_offset)*self.nand_block_size_plus_ras
+
+        digests = {name: hashlib.new(name) for name in hashes}
+        page_queue = queue.Queue(self.DUMP_QUEUE_DEPTH)
+        # one buffer per queue slot, plus the ones being read and written
+        pool = self.page_pool(self.DUMP_QUEUE_DEPTH + 2)
+        writer_errors = []
+
+        if container:
+            dumpfile = ContainerWriter(filename, self.nand_page_size, self.nand_ras,
+                                       self.nand_pages_per_block, self.mf_id,
+                                       self.device_id, block_offset)
+        else:
+            dumpfile = open(filename, "r+b" if resume_offset else "wb")
+
+        with dumpfile:
+            if resume_offset:
+                print(f"Resuming dump at block {start_block:x}...")
+                resume_dumpfile(dumpfile, resume_offset, digests.values())
+            if ecc:
+                ecc.first_page = start_block*self.nand_pages_per_block
+
+            writer = threading.Thread(
+                target=dump_writer,
+                args=(dumpfile, page_queue, digests.values(), writer_errors,
+                      journal or None, start_block, self.nand_pages_per_block,
+                      pool, ecc),
+                name="dump-writer")
+            writer.start()
+            try:
+                pages = range(start_block*self.nand_pages_per_block, last_page)
+                if consistency and consistency.mode == "reread":
+                    reads = self.reread_pages(pages, window, pool, consistency)
+                else:
+                    reads = self.readpages(pages, window, pool)
+                for page, data in reads:
+                    page_queue.put(data)
+                    if writer_errors:
+                        break
+                    self.report_progress(
+                        (page-first_page+1)*self.nand_page_size_plus_ras,
+                        nblocks*self.nand_block_size_plus_ras)
+            finally:
+                page_queue.put(None)
+                writer.join()
+                if journal:
+                    journal.save()
+
+        if writer_errors:
+            raise writer_errors[0]
+
+        if consistency:
+            if consistency.mode == "ecc":
+                ecc_report = ecc.finish()
+                consistency.suspect = [entry[0] for kind in ("corrected", "ecc_errors",
+                                                             "uncorrectable")
+                                       for entry in ecc_report[kind]]
+            consistency.report["pages"] = last_page - start_block*self.nand_pages_per_block
+            patched = self.settle_pages(filename, first_page, consistency, window)
+            if ecc and patched:
+                # the ECC report is for the pages as they are in the dump now
+                ecc.finish()
+                ecc.replace_pages(patched)
+            if consistency.report["patched"] and digests:
+                digests = {name: hashlib.new(name) for name in hashes}
+                with open(filename, "rb") as dumpfile:
+                    for chunk in iter(lambda: dumpfile.read(1 << 20), b""):
+                        for digest in digests.values():
+                            digest.update(chunk)
+
+        if journal:
+            journal.remove()
+
+        return {name: digest.hexdigest() for name, digest in digests.items()}
+
+    def reread_pages(self, pages, window: int, pool: BufferPool, check: "ConsistencyCheck"):
+        """
+        readpages() for a "reread" ConsistencyCheck: each page is read twice
+        in a row in the same pipeline, and pages whose two reads differ are
+        noted as suspect. Yields (page, data) with the first read.
+        """
+        reads = self.readpages((page for page in pages for _ in range(2)), window, pool)
+        try:
+            for page, first in reads:
+                try:
+                    _, second = next(reads)
+                except BaseException:
+                    # the read of the copy failed, first is still ours
+                    pool.put(first)
+                    raise
+                if not same_data(first, second):
+                    check.suspect.append(page)
+                pool.put(second)
+                yield page, first
+        finally:
+            reads.close()
+
+    def settle_pages(self, filename: str, first_page: int, check: "ConsistencyCheck",
+                     window: int = READ_WINDOW):
+        """
+        Read the suspect pages of a ConsistencyCheck again, one pipelined
+        pass per round, until each reads the same twice in a row or
+        check.retries rounds have passed. Settled pages are written into
+        the dump in filename, whose first page is first_page, where they
+        differ from it; pages that never settle are left as dumped.
+        The results go into check.report.
+        Returns {page: data} of the pages patched in the dump.
+        """
+        report = check.report
+        report["suspect"] = sorted(set(check.suspect))
+        reads = {page: 0 for page in report["suspect"]}
+        last_read = {}
+        settled = {}
+        unsettled = report["suspect"]
+        if unsettled:
+            print(f"Reading {len(unsettled)} suspect pages again...")
+        for _ in range(check.retries):
+            if not unsettled:
+                break
+            still = []
+            for page, data in self.readpages(unsettled, window):
+                reads[page] += 1
+                if last_read.get(page) == data:
+                    settled[page] = data
+                else:
+                    last_read[page] = data
+                    still.append(page)
+            unsettled = still
+
+        report["settled"] = {page: reads[page] for page in sorted(settled)}
+        report["unstable"] = unsettled
+        patched = {}
+        if not settled:
+            return patched
+        with open(filename, "r+b") as dumpfile:
+            for page, data in sorted(settled.items()):
+                offset = (page - first_page)*self.nand_page_size_plus_ras
+                dumpfile.seek(offset)
+                if dumpfile.read(len(data)) != data:
+                    dumpfile.seek(offset)
+                    dumpfile.write(data)
+                    report["patched"].append(page)
+                    patched[page] = data
+        return patched
+
+    def dump_regions(self, filename: str, regions: list, window: int = READ_WINDOW):
+        """
+        Dump (name, first block, block count) regions of the NAND in one
+        pass, each at its own offset in the file as in a full dump, so the
+        file can be written back with the same regions. The space between
+        regions is left as a hole.
+        """
+        pages = [page for block in region_blocks(regions)
+                 for page in range(block*self.nand_pages_per_block,
+                                   (block+1)*self.nand_pages_per_block)]
+        total = len(pages)*self.nand_page_size_plus_ras
+        pool = self.page_pool(2)
+        done = 0
+
         with open(filename, "wb") as dumpfile:
-            for page in range(block_offset*self.nand_pages_per_block, (block_offset+nblocks)*self.nand_pages_per_block, 1):
-                data = self.readpage(page)
+            for page, data in self.readpages(pages, window, pool):
+                offset = page*self.nand_page_size_plus_ras
+                if dumpfile.tell() != offset:
+                    dumpfile.seek(offset)
                 dumpfile.write(data)
-                # print "\r%d KB / %d KB"%((page-(block_offset*self.NAND_PAGES_PER_BLOCK)+1)*self.NAND_PAGE_SZ_PLUS_RAS/1024, nblocks*self.NAND_BLOCK_SZ_PLUS_RAS/1024),
-                dump_size_progress = (
-                    page-(block_offset*self.nand_pages_per_block)+1)*self.nand_page_size_plus_ras/1024
-                dump_size_total = nblocks*self.nand_block_size_plus_ras/1024
-                print(f"{dump_size_progress} KB / {dump_size_total} KB", end="\r")
-                sys.stdout.flush()
-
-    def program_block(self, data: bytes, pgblock: int, verify: bool):
-        pagenr = 0
+                pool.put(data)
+                done += self.nand_page_size_plus_ras
+                self.report_progress(done, total)
 
+    def program_block(self, data: bytes, pgblock: int, verify: bool,
+                      window: int = 0, skip_erased: bool = True):
+        """
+        Erase a NAND block and program it with data.
+        Pages that are entirely 0xFF already hold their contents once the
+        block is erased, so they are not sent unless skip_erased is False.
+        """
         datasize = len(data)
         if datasize != self.nand_block_size_plus_ras:
             print(
                 f"Incorrect length {datasize} != {self.nand_block_size_plus_ras}")
             return -1
 
-        while pagenr < self.nand_pages_per_block:
-            real_pagenr = (pgblock * self.nand_pages_per_block) + pagenr
-            if pagenr == 0:
-                self.erase_block(real_pagenr)
-
-            self.writepage(data[pagenr*self.nand_page_size_plus_ras:(pagenr+1)
-                           * self.nand_page_size_plus_ras], real_pagenr)
-
-            pagenr += 1
+        first_page = pgblock * self.nand_pages_per_block
+        self.erase_block(first_page)
+
+        erased_page = b"\xff" * self.nand_page_size_plus_ras
+        pages = ((first_page + pagenr,
+                  data[pagenr*self.nand_page_size_plus_ras:(pagenr+1)
+                       * self.nand_page_size_plus_ras])
+                 for pagenr in range(self.nand_pages_per_block))
+        if skip_erased:
+            pages = ((page_number, page_data) for page_number, page_data in pages
+                     if not same_data(erased_page, page_data))
+        if self.writepages(pages, window):
+            print(f"Block 0x{pgblock:x} - error programming block")
+            return -1
 
         # verification
         if verify:
-            pagenr = 0
-            while pagenr < self.nand_pages_per_block:
-                real_pagenr = (pgblock * self.nand_pages_per_block) + pagenr
-                if data[pagenr*self.nand_page_size_plus_ras:(pagenr+1)*self.nand_page_size_plus_ras] != self.readpage(real_pagenr):
-                    print()
-                    # print "Error! Block verification failed. block=0x%x page=%d"%(pgblock, real_pagenr)
-                    print(
-                        "Error! Block verification failed.",
-                        f"block=0x{pgblock:x} page=0x{real_pagenr:x}"
-                        )
-                    return -1
+            pool = self.page_pool(1)
+            buf = pool.get()
+            try:
+                pagenr = 0
+                while pagenr < self.nand_pages_per_block:
+                    real_pagenr = (pgblock * self.nand_pages_per_block) + pagenr
+                    if not same_data(self.readpage_into(real_pagenr, buf), data[pagenr*self.nand_page_size_plus_ras:(pagenr+1)*self.nand_page_size_plus_ras]):
+                        print()
+                        # print "Error! Block verification failed. block=0x%x page=%d"%(pgblock, real_pagenr)
+                        print(
+                            "Error! Block verification failed.",
+                            f"block=0x{pgblock:x} page=0x{real_pagenr:x}"
+                            )
+                        return -1
+
+                    pagenr += 1
+            finally:
+                pool.put(buf)
+
+        return 0
 
-                pagenr += 1
+    def program_block_verified(self, data: bytes, pgblock: int, verify: bool,
+                               window: int = 0, skip_erased: bool = True):
+        """
+        program_block(), erasing and writing the block again up to
+        VERIFY_RETRIES times if it fails, as verify_program() does for
+        blocks that fail the deferred verify.
+        Returns -1 if the block still fails.
+        """
+        for attempt in range(self.VERIFY_RETRIES + 1):
+            if self.program_block(data, pgblock, verify, window, skip_erased) == 0:
+                return 0
+            if attempt < self.VERIFY_RETRIES:
+                print(f"Rewriting block 0x{pgblock:x}...")
+                self.metrics.count_retry("verify" if verify else "write")
+        return -1
+
+    def program_image_block(self, data: bytes, pgblock: int, verify: bool, window: int = 0,
+                            skip_erased: bool = True, smart: bool = False,
+                            manifest: "Manifest" = None) -> str:
+        """
+        Write one block of an image as program_blocks() and program_stream()
+        do: leave it be if the manifest knows it holds data or, in smart
+        mode, it reads back the same; otherwise forget it in the manifest
+        and program it with program_block_verified().
+        Returns "unchanged", "matched", "written" or "failed".
+        """
+        if manifest and manifest.matches(pgblock, data):
+            return "unchanged"
+        if smart and self.block_matches(data, pgblock):
+            return "matched"
+        if manifest:
+            manifest.forget(pgblock)
+        if self.program_block_verified(data, pgblock, verify, window, skip_erased) == -1:
+            return "failed"
+        return "written"
+
+    def dump_dual(self, other, filenames: list, block_offset: int, nblocks: int,
+                  window: int = READ_WINDOW):
+        """
+        Dump this NAND and its companion() in one session. Page reads for
+        the two chips alternate on the link, so one chip's busy time is
+        hidden behind the other's transfer. Both must already be identified
+        with readid() and have the same geometry.
+        With two filenames each NAND is dumped to its own file; with one,
+        the pages are interleaved into a single image, one page from each
+        NAND in turn starting with NAND0.
+        """
+        nands = sorted((self, other), key=lambda nand: nand.nand_id)
+        if (self.nand_page_size_plus_ras != other.nand_page_size_plus_ras or
+                self.nand_pages_per_block != other.nand_pages_per_block or
+                self.nand_block_count != other.nand_block_count):
+            print("Error: NAND0 and NAND1 have different geometry")
+            return -1
+
+        if nblocks == 0 or block_offset + nblocks > self.nand_block_count:
+            nblocks = self.nand_block_count - block_offset
+
+        first_page = block_offset*self.nand_pages_per_block
+        last_page = (block_offset+nblocks)*self.nand_pages_per_block
+        requests = ((nand, page) for page in range(first_page, last_page)
+                    for nand in nands)
+
+        writer_errors = []
+        with ExitStack() as stack:
+            page_queues = []
+            for filename in filenames:
+                dumpfile = stack.enter_context(open(filename, "wb"))
+                page_queue = queue.Queue(self.DUMP_QUEUE_DEPTH)
+                writer = threading.Thread(
+                    target=dump_writer,
+                    args=(dumpfile, page_queue, (), writer_errors),
+                    name=f"dump-writer-{filename}")
+                writer.start()
+                stack.callback(writer.join)
+                stack.callback(page_queue.put, None)
+                page_queues.append(page_queue)
+
+            for nand, page, data in self.pipelined_reads(requests, window):
+                page_queues[nand.nand_id % len(page_queues)].put(data)
+                if writer_errors:
+                    break
+                if nand is nands[-1]:
+                    self.report_progress(
+                        (page-first_page+1)*self.nand_page_size_plus_ras*2,
+                        nblocks*self.nand_block_size_plus_ras*2)
+
+        if writer_errors:
+            raise writer_errors[0]
 
         return 0
 
-    def program(self, data: bytes, verify: bool, block_offset: int, nblocks: int):
-        "Program a NAND chip."
+    def badblocks(self, block_offset: int, nblocks: int, convention: str = "",
+                  window: int = READ_WINDOW, suspect: list = None):
+        """
+        Scan the NAND for bad blocks by reading only the pages that carry
+        the bad block markers (see badblock_markers()), pipelined.
+        Blocks whose marker pages cannot be read are added to suspect, if
+        given, and the scan carries on with the next block.
+        Returns the sorted list of bad block numbers.
+        """
+        if nblocks == 0 or block_offset + nblocks > self.nand_block_count:
+            nblocks = self.nand_block_count - block_offset
+
+        marker_pages, marker_offset = badblock_markers(
+            self.nand_page_size, self.nand_pages_per_block, convention)
+        marker = self.nand_page_size + marker_offset
+
+        pages = [block*self.nand_pages_per_block + marker_page
+                 for block in range(block_offset, block_offset + nblocks)
+                 for marker_page in marker_pages]
+        bad_blocks = []
+        done = 0
+        while done < len(pages):
+            try:
+                for page, data in self.readpages(pages[done:], window):
+                    done += 1
+                    block = page // self.nand_pages_per_block
+                    if data[marker] != 0xFF and block not in bad_blocks:
+                        bad_blocks.append(block)
+                    self.report_progress(done*self.nand_page_size_plus_ras,
+                                         len(pages)*self.nand_page_size_plus_ras)
+            except NANDError:
+                if not getattr(self.ser, "is_open", True):
+                    raise
+                # the page that failed is the next one in order
+                block = pages[done] // self.nand_pages_per_block
+                print(f"Block 0x{block:x}: cannot read its bad block markers")
+                if suspect is not None:
+                    suspect.append(block)
+                while done < len(pages) and pages[done] // self.nand_pages_per_block == block:
+                    done += 1
+
+        return bad_blocks
+
+    def block_matches(self, data: bytes, pgblock: int, window: int = READ_WINDOW):
+        """
+        Check whether a NAND block already holds data.
+        The block is read with readpages() and reading stops at the first
+        page that differs.
+        """
+        first_page = pgblock * self.nand_pages_per_block
+        pool = self.page_pool(2)
+        pages = self.readpages(
+            range(first_page, first_page + self.nand_pages_per_block), window, pool)
+        for page, page_data in pages:
+            offset = (page - first_page) * self.nand_page_size_plus_ras
+            matches = same_data(page_data, data[offset:offset + self.nand_page_size_plus_ras])
+            pool.put(page_data)
+            if not matches:
+                pages.close()
+                return False
+
+        return True
+
+    def check_container(self, data) -> int:
+        """
+        Refuse to write an ImageContainer that was made for another chip
+        or another part of one (see ImageContainer.mismatch()).
+        Returns -1 on error.
+        """
+        if isinstance(data, ImageContainer):
+            problem = data.mismatch(self.chip_state())
+            if problem:
+                print(f"Error: cannot write this image container: {problem}")
+                return -1
+        return 0
+
+    def program(self, data: bytes, verify: bool, block_offset: int, nblocks: int,
+                window: int = 0, skip_erased: bool = True, smart: bool = False,
+                journal: str = "", resume: bool = False, inline_verify: bool = False,
+                manifest: "Manifest" = None, image_key: str = ""):
+        """
+        Program a NAND chip.
+        With verify, the whole range is programmed first and then read back
+        in one pass by verify_program(), unless inline_verify asks for each
+        block to be read back straight after it is written.
+        In smart mode each block is read back first, and only blocks that
+        differ from data are erased and programmed.
+        If a journal path is given, progress is recorded there, and with
+        resume programming continues from the last block the journal saw
+        completed for the same chip, range and image. The image is known by
+        image_key, such as image_file_key() gives, or else by its SHA-256,
+        which takes a pass over the whole image.
+        With a Manifest, blocks it knows to hold their data already are
+        skipped without reading them, and it is updated afterwards.
+        data may also be an iterator over the blocks of the image, which is
+        handed to program_stream() and gets no journal.
+        Returns -1 on error.
+        """
+        if not hasattr(data, "__len__"):
+            return self.program_stream(data, verify, block_offset, nblocks, window,
+                                       skip_erased, smart, inline_verify, manifest)
+
+        if self.check_container(data) == -1:
+            return -1
+
         datasize = len(data)
 
         if nblocks == 0:
@@ -463,26 +1591,1107 @@ class NANDFlasher(TeensySerial):
                 f"Error: nand has {self.nand_block_count:x}, writing outside the nand's capacity")
             return -1
 
-        block = 0
+        resume_block = 0
+
+        if journal:
+            journal = Journal(journal, self.journal_state(
+                "write", block_offset, nblocks, image_key or image_sha256(data)))
+            if resume:
+                resume_block = journal.resume()
 
         # print "Writing %x blocks to device (starting at offset %x)..."%(nblocks, block_offset)
         print(
             f"Writing {nblocks:x} blocks to device (starting at offset {block_offset:x})...")
+        if resume_block > block_offset:
+            print(f"Resuming write at block {resume_block:x}...")
 
-        while block < nblocks:
-            pgblock = block+block_offset
-            self.program_block(data[pgblock*self.nand_block_size_plus_ras:(
-                pgblock+1)*self.nand_block_size_plus_ras], pgblock, verify)
+        return self.program_blocks(data, range(block_offset, block_offset + nblocks),
+                                   verify, window, skip_erased, smart, journal or None,
+                                   resume_block, inline_verify, manifest)
 
-            write_progress = ((block+1)*self.nand_block_size_plus_ras)/1024
-            write_total = (nblocks*self.nand_block_size_plus_ras)/1024
-            print(f"{write_progress} KB / {write_total} KB", end="\r")
-            # print "\r%d KB / %d KB"%(((block+1)*self.NAND_BLOCK_SZ_PLUS_RAS)/1024, (nblocks*self.NAND_BLOCK_SZ_PLUS_RAS)/1024),
-            sys.stdout.flush()
+    def program_blocks(self, data: bytes, blocks, verify: bool, window: int = 0,
+                       skip_erased: bool = True, smart: bool = False,
+                       journal: "Journal" = None, resume_block: int = 0,
+                       inline_verify: bool = False, manifest: "Manifest" = None):
+        """
+        Program an ascending sequence of blocks from data, in one pass, with
+        the verification, smart mode, journal and manifest handling of
+        program().
+        Blocks before resume_block are taken as already programmed: they
+        are not written again, but they are verified.
+        The manifest records the blocks that were verified or found to
+        match. A block is forgotten before it is erased, and the manifest
+        is saved even if programming stops partway.
+        Returns -1 on error.
+        """
+        if self.check_container(data) == -1:
+            return -1
 
-            block += 1
+        blocks = list(blocks)
+        skipped = set()
+        unchanged = set()
+        failed = set()
 
-        print()
+        try:
+            for index, pgblock in enumerate(blocks):
+                if pgblock < resume_block:
+                    continue
+                outcome = self.program_image_block(
+                    data[pgblock*self.nand_block_size_plus_ras:(
+                        pgblock+1)*self.nand_block_size_plus_ras], pgblock,
+                    verify and inline_verify, window, skip_erased, smart, manifest)
+                if outcome == "unchanged":
+                    unchanged.add(pgblock)
+                elif outcome == "matched":
+                    skipped.add(pgblock)
+                elif outcome == "failed":
+                    failed.add(pgblock)
+
+                self.report_progress((index+1)*self.nand_block_size_plus_ras,
+                                     len(blocks)*self.nand_block_size_plus_ras)
+
+                if journal:
+                    journal.update(pgblock + 1)
+
+            print()
+            if manifest:
+                print(f"Skipped {len(unchanged):x} of {len(blocks):x} blocks unchanged",
+                      "according to the manifest")
+            if smart:
+                print(f"Skipped {len(skipped):x} of {len(blocks):x} blocks that already matched")
+
+            mismatched = set()
+            if verify and not inline_verify:
+                mismatched = set(self.verify_program(data, [pgblock for pgblock in blocks
+                                                            if pgblock not in skipped | unchanged],
+                                                     window, skip_erased))
+                # the verify pass rewrote and checked them
+                failed.clear()
+
+            if manifest:
+                for pgblock in blocks:
+                    if pgblock in skipped or (verify and pgblock not in failed
+                                              and pgblock not in mismatched):
+                        manifest.record(pgblock, data[pgblock*self.nand_block_size_plus_ras:(
+                            pgblock+1)*self.nand_block_size_plus_ras])
+        finally:
+            if journal:
+                journal.save()
+            if manifest:
+                manifest.save()
+
+        if failed:
+            print("Error! Programming failed.",
+                  " ".join(f"block=0x{pgblock:x}" for pgblock in sorted(failed)))
+        if mismatched or failed:
+            return -1
+
+        if journal:
+            journal.remove()
+
+        return 0
+
+    def program_stream(self, blocks, verify: bool, block_offset: int, nblocks: int,
+                       window: int = 0, skip_erased: bool = True, smart: bool = False,
+                       inline_verify: bool = False, manifest: "Manifest" = None):
+        """
+        Program the NAND from an iterator over the blocks of an image, from
+        the image's first block on, such as stream_blocks() gives for a
+        compressed file, without holding the whole image at any time.
+        Blocks are programmed as program_blocks() does. The deferred verify
+        runs whenever STREAM_VERIFY_BYTES of written blocks are held, so
+        blocks that differ can still be rewritten with verify_program().
+        With nblocks 0, programming stops where the image or the NAND ends.
+        The manifest is handled as by program_blocks().
+        Returns -1 on error.
+        """
+        block_size = self.nand_block_size_plus_ras
+        end = self.nand_block_count if nblocks == 0 else block_offset + nblocks
+        if end > self.nand_block_count:
+            print(f"Error: nand has {self.nand_block_count:x}, writing outside the nand's capacity")
+            return -1
+
+        print(f"Writing {end - block_offset:x} blocks to device (starting at offset",
+              f"{block_offset:x}) as the image is read...")
+
+        deferred_verify = verify and not inline_verify
+        pending = StreamedBlocks(block_size)
+        batch = max(1, self.STREAM_VERIFY_BYTES // block_size)
+        written = set()
+        digests = {}
+        skipped = set()
+        unchanged = set()
+        failed = set()
+        done = block_offset
+        try:
+            try:
+                for pgblock, block_data in enumerate(blocks):
+                    if pgblock >= end:
+                        break
+                    if pgblock < block_offset:
+                        continue
+                    if len(block_data) != block_size:
+                        print(f"Error: the image ends in a partial block of {len(block_data)} bytes")
+                        failed.add(pgblock)
+                        break
+
+                    outcome = self.program_image_block(block_data, pgblock,
+                                                       verify and inline_verify, window,
+                                                       skip_erased, smart, manifest)
+                    if outcome == "unchanged":
+                        unchanged.add(pgblock)
+                    elif outcome == "failed":
+                        failed.add(pgblock)
+                    else:
+                        written.add(pgblock)
+                        if manifest:
+                            digests[pgblock] = block_digest(block_data)
+                        if outcome == "matched":
+                            skipped.add(pgblock)
+                        elif deferred_verify:
+                            pending.blocks[pgblock] = block_data
+
+                    done = pgblock + 1
+                    self.report_progress((done-block_offset)*block_size, (end-block_offset)*block_size)
+
+                    if len(pending.blocks) >= batch:
+                        print()
+                        self.verify_stream_batch(pending, failed, window, skip_erased)
+            finally:
+                if hasattr(blocks, "close"):
+                    blocks.close()
+
+            print()
+            if nblocks and done < end and not failed:
+                print(f"Error: the image ends at block {done:x}, before block {end:x}")
+                failed.add(done)
+            if manifest:
+                print(f"Skipped {len(unchanged):x} of {done - block_offset:x} blocks unchanged",
+                      "according to the manifest")
+            if smart:
+                print(f"Skipped {len(skipped):x} of {done - block_offset:x} blocks that already matched")
+
+            if pending.blocks:
+                self.verify_stream_batch(pending, failed, window, skip_erased)
+
+            if manifest:
+                for pgblock in range(block_offset, done):
+                    if pgblock in skipped or (verify and pgblock in written and
+                                              pgblock not in failed):
+                        manifest.record_digest(pgblock, digests[pgblock])
+        finally:
+            if manifest:
+                manifest.save()
+
+        return -1 if failed else 0
+
+    def verify_stream_batch(self, pending: "StreamedBlocks", failed: set, window: int,
+                            skip_erased: bool):
+        """
+        The deferred verify of program_stream() for the blocks it holds:
+        verify_program() them, adding those that still differ to failed,
+        and let them go.
+        """
+        failed.update(self.verify_program(pending, sorted(pending.blocks), window, skip_erased))
+        pending.blocks.clear()
+
+    def verify_blocks(self, data: bytes, blocks: list, window: int = READ_WINDOW):
+        """
+        Read back blocks in one pipelined pass and compare them with data,
+        the image the blocks were programmed from. Pages are compared on a
+        worker thread (see verify_checker()) so the link stays busy.
+        A block with a page that cannot be read counts as differing.
+        Returns the sorted list of blocks that differ.
+        """
+        page_queue = queue.Queue(self.DUMP_QUEUE_DEPTH)
+        pool = self.page_pool(self.DUMP_QUEUE_DEPTH + 2)
+        mismatched = set()
+        checker_errors = []
+        checker = threading.Thread(
+            target=verify_checker,
+            args=(data, page_queue, self.nand_page_size_plus_ras,
+                  self.nand_pages_per_block, mismatched, pool, checker_errors),
+            name="verify-checker")
+        checker.start()
+
+        pages = [pgblock*self.nand_pages_per_block + pagenr
+                 for pgblock in blocks for pagenr in range(self.nand_pages_per_block)]
+        done = 0
+        try:
+            while done < len(pages) and not checker_errors:
+                try:
+                    for page, page_data in self.readpages(pages[done:], window, pool):
+                        page_queue.put((page, page_data))
+                        done += 1
+                        if checker_errors:
+                            break
+                        self.report_progress(done*self.nand_page_size_plus_ras,
+                                             len(pages)*self.nand_page_size_plus_ras)
+                except NANDError:
+                    if not getattr(self.ser, "is_open", True):
+                        raise
+                    # the page that failed is the next one in order
+                    pgblock = pages[done] // self.nand_pages_per_block
+                    print(f"Block 0x{pgblock:x}: read error while verifying")
+                    mismatched.add(pgblock)
+                    while done < len(pages) and pages[done] // self.nand_pages_per_block == pgblock:
+                        done += 1
+        finally:
+            page_queue.put(None)
+            checker.join()
+
+        if checker_errors:
+            raise checker_errors[0]
+
+        return sorted(mismatched)
+
+    def verify_program(self, data: bytes, blocks: list, window: int = 0,
+                       skip_erased: bool = True):
+        """
+        Verify programmed blocks with verify_blocks(), then erase and
+        rewrite the ones that differ and verify those again, up to
+        VERIFY_RETRIES times.
+        Returns the blocks that still differ, empty if all verified.
+        """
+        if not blocks:
+            return []
+        for attempt in range(self.VERIFY_RETRIES + 1):
+            print(f"Verifying {len(blocks):x} blocks...")
+            blocks = self.verify_blocks(data, blocks)
+            print()
+            if not blocks:
+                return []
+            if attempt == self.VERIFY_RETRIES:
+                break
+
+            print(f"Rewriting {len(blocks):x} blocks that failed verification:",
+                  " ".join(f"0x{pgblock:x}" for pgblock in blocks))
+            for pgblock in blocks:
+                self.metrics.count_retry("verify")
+                self.program_block(data[pgblock*self.nand_block_size_plus_ras:(
+                    pgblock+1)*self.nand_block_size_plus_ras], pgblock, False, window,
+                                   skip_erased)
+
+        print("Error! Block verification failed.",
+              " ".join(f"block=0x{pgblock:x}" for pgblock in blocks))
+        return blocks
+
+    def open(self, spare: bool = False, cache_pages: int = 0, readahead: int = None):
+        "The chip as a read-only file, see NANDFile."
+        return NANDFile(self, spare, cache_pages, readahead)
+
+
+class NANDFile(io.RawIOBase):
+    """
+    Read-only, seekable file view of a NAND chip, for tools that only need
+    parts of it. With spare=True file offsets cover every page with its
+    spare area, as laid out in a dump; otherwise only the page data.
+    Pages read are kept in an LRU cache of cache_pages pages. When a read
+    carries on where the previous one ended, the following `readahead`
+    pages (READAHEAD unless given; 0 turns read-ahead off) are fetched
+    with it as one pipelined batch.
+    """
+    CACHE_PAGES = 256
+    READAHEAD = 32
+
+    def __init__(self, flasher: NANDFlasher, spare: bool = False, cache_pages: int = 0,
+                 readahead: int = None):
+        super().__init__()
+        self.flasher = flasher
+        self.spare = spare
+        self.unit = flasher.nand_page_size_plus_ras if spare else flasher.nand_page_size
+        self.size = flasher.nand_page_count * self.unit
+        self.cache_pages = max(1, cache_pages or self.CACHE_PAGES)
+        self.readahead = min(self.READAHEAD if readahead is None else readahead,
+                             self.cache_pages - 1)
+        self.cache = OrderedDict()
+        self.position = 0
+        # page after the last one a read touched, to spot sequential reads
+        self.next_page = -1
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence {whence}")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return offset
+
+    def fetch(self, first: int, last: int):
+        "Make sure pages first to last (inclusive) are in the cache."
+        if first == self.next_page:
+            last = min(max(last, first + self.readahead), self.flasher.nand_page_count - 1)
+        missing = []
+        for page in range(first, last + 1):
+            if page in self.cache:
+                self.cache.move_to_end(page)
+            else:
+                missing.append(page)
+        for page, data in self.flasher.readpages(missing):
+            self.cache[page] = data
+            if len(self.cache) > self.cache_pages:
+                self.cache.popitem(last=False)
+
+    def page(self, page: int):
+        "The cached contents of a page, most recently used last."
+        if page not in self.cache:
+            self.fetch(page, page)
+        self.cache.move_to_end(page)
+        return self.cache[page]
+
+    def readinto(self, buffer):
+        self._checkClosed()
+        view = memoryview(buffer).cast("B")
+        length = min(len(view), max(0, self.size - self.position))
+        if length == 0:
+            return 0
+
+        first = self.position // self.unit
+        last = (self.position + length - 1) // self.unit
+        # a read larger than the cache goes straight through in cache-sized batches
+        done = 0
+        for batch in range(first, last + 1, self.cache_pages):
+            self.fetch(batch, min(batch + self.cache_pages, last + 1) - 1)
+            for page in range(batch, min(batch + self.cache_pages, last + 1)):
+                start = (self.position + done) % self.unit
+                count = min(self.unit - start, length - done)
+                view[done:done + count] = memoryview(self.page(page))[start:start + count]
+                done += count
+        self.next_page = last + 1
+        self.position += done
+        return done
+
+
+class Progress:
+    """
+    Progress of a long operation, shown at most every `interval` seconds
+    with the current and average speed and an estimate of the time left.
+    Modes are "tty" (one line redrawn in place), "json" (one JSON object
+    per line, for logs and scripts) and "none"; "auto" picks tty when
+    the stream is a terminal and none otherwise.
+    """
+    INTERVAL = 0.5
+
+    def __init__(self, mode: str = "auto", stream=None, interval: float = INTERVAL):
+        self.stream = stream or sys.stdout
+        if mode == "auto":
+            mode = "tty" if self.stream.isatty() else "none"
+        if mode not in ("tty", "json", "none"):
+            raise ValueError(f"Unknown progress mode: {mode}")
+        self.mode = mode
+        self.interval = interval
+        self.total = 0
+        self.start_time = self.last_time = 0.0
+        self.last_done = 0
+        self.line_length = 0
+
+    def update(self, done: int, total: int, unit_size: int = 0):
+        """
+        Note that done of total bytes are finished, unit_size being the
+        size of a page for the pages/s figure. A new operation starts
+        whenever total changes or done goes backwards.
+        """
+        if self.mode == "none":
+            return
+
+        now = time.monotonic()
+        if total != self.total or done < self.last_done:
+            self.total = total
+            self.start_time = self.last_time = now
+            self.last_done = 0
+        elif done < total and now - self.last_time < self.interval:
+            return
+
+        elapsed = now - self.last_time
+        rate = (done - self.last_done) / elapsed if elapsed else 0.0
+        elapsed = now - self.start_time
+        average = done / elapsed if elapsed else 0.0
+        eta = (total - done) / average if average else None
+        self.last_time = now
+        self.last_done = done
+
+        if self.mode == "json":
+            print(json.dumps({
+                "done": done,
+                "total": total,
+                "kb_per_s": round(rate / 1024, 1),
+                "average_kb_per_s": round(average / 1024, 1),
+                "pages_per_s": round(average / unit_size, 1) if unit_size else None,
+                "eta": round(eta, 1) if eta is not None else None,
+            }), file=self.stream, flush=True)
+            return
+
+        line = (f"{done/1024:.0f} KB / {total/1024:.0f} KB  "
+                f"{rate/1024:.1f} KB/s (avg {average/1024:.1f} KB/s")
+        if unit_size:
+            line += f", {average/unit_size:.0f} pages/s"
+        line += f")  ETA {datetime.timedelta(seconds=round(eta)) if eta is not None else '?'}"
+        print(line.ljust(self.line_length), end="\r", file=self.stream, flush=True)
+        self.line_length = len(line)
+
+
+# where the journals of writes are kept unless --journal names a directory
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".nandway3", "journals")
+
+
+def journal_path(filename: str, directory: str = "") -> str:
+    """
+    Where the Journal for a dump to, or a write from, filename goes: next
+    to the file unless a directory is given. Journals in a shared
+    directory are told apart by a hash of the file's full path.
+    """
+    if not directory:
+        return filename + ".journal"
+    path_hash = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:8]
+    return os.path.join(directory, f"{os.path.basename(filename)}-{path_hash}.journal")
+
+
+def image_file_key(filename: str) -> str:
+    """
+    Cheap identity of an image file for a write Journal: its full path,
+    size and modification time, so resuming does not hash the image.
+    """
+    stat = os.stat(filename)
+    return f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class Journal:
+    """
+    Progress journal of a dump or a write.
+    It records the chip, the block range and the next block to process,
+    so an interrupted run can be resumed instead of started over.
+    """
+    # Seconds between journal writes while an operation is running
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, path: str, state: dict):
+        self.path = path
+        self.state = state
+        self.next_block = state["block_offset"]
+        self.last_save = 0.0
+
+    def resume(self):
+        """
+        Load the journal from disk and return the block to continue from.
+        Raises NANDError if it was written for another chip, range or image.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as journalfile:
+                saved = json.load(journalfile)
+        except FileNotFoundError:
+            print(f"No journal found at {self.path}, starting from the beginning")
+            return self.next_block
+
+        next_block = saved.pop("next_block", self.next_block)
+        if saved != self.state:
+            raise NANDError(
+                f"Journal {self.path} was written for a different chip, range or image")
+
+        self.next_block = next_block
+        return next_block
+
+    def update(self, next_block: int):
+        "Record that every block before next_block is done."
+        self.next_block = next_block
+        if time.monotonic() - self.last_save >= self.SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        "Write the journal to disk."
+        self.last_save = time.monotonic()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as journalfile:
+            json.dump(dict(self.state, next_block=self.next_block), journalfile)
+        os.replace(temp_path, self.path)
+
+    def remove(self):
+        "Delete the journal once the operation has completed."
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Manifest:
+    """
+    What is known to be on a board's chip: a content hash per block, kept
+    in a JSON file per board label and chip (ID and geometry). Verified
+    writes and dumps record blocks, and later writes skip the blocks whose
+    hash matches their data without reading the chip back.
+    Anything that changes the chip behind NANDway's back makes it stale.
+    """
+
+    def __init__(self, directory: str, label: str, chip: dict):
+        safe_label = "".join(char if char.isalnum() or char in "-_." else "_"
+                             for char in label)
+        self.path = os.path.join(
+            directory,
+            f"{safe_label}-{chip['mf_id']:02x}{chip['device_id']:02x}-{chip['page_size']}"
+            f"+{chip['ras']}x{chip['pages_per_block']}x{chip['block_count']}.json")
+        self.state = dict(chip, label=label)
+        self.blocks = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as manifestfile:
+                saved = json.load(manifestfile)
+        except FileNotFoundError:
+            return
+        if saved.get("state") == self.state:
+            self.blocks = {int(block): digest for block, digest in saved["blocks"].items()}
+
+    def matches(self, block: int, data) -> bool:
+        "Whether block is known to hold data."
+        return self.blocks.get(block) == block_digest(data)
+
+    def record(self, block: int, data):
+        "Note that block holds data."
+        self.record_digest(block, block_digest(data))
+
+    def record_digest(self, block: int, digest: str):
+        "Note that block holds data with the given block_digest()."
+        self.blocks[block] = digest
+
+    def record_image(self, image, first_block: int, block_size: int):
+        "Note that the blocks from first_block on hold the blocks of image."
+        for block in range(len(image) // block_size):
+            self.record(first_block + block, image[block*block_size:(block+1)*block_size])
+
+    def forget(self, block: int):
+        "Note that what block holds is not known."
+        self.blocks.pop(block, None)
+
+    def save(self):
+        "Write the manifest to disk."
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as manifestfile:
+            json.dump({"state": self.state,
+                       "blocks": {str(block): digest
+                                  for block, digest in sorted(self.blocks.items())}},
+                      manifestfile)
+        os.replace(temp_path, self.path)
+
+
+def block_digest(data) -> str:
+    "Hash of a block's contents, as used by the Manifest and diff_images()."
+    return new_block_digest(data).hexdigest()
+
+
+def new_block_digest(data=b""):
+    "A hashlib object for computing block_digest() piece by piece."
+    return hashlib.sha1(data)
+
+
+def resume_dumpfile(dumpfile, resume_offset: int, digests):
+    """
+    Prepare a partial dump for resuming at resume_offset: re-hash the part
+    that is already on disk and drop anything written after it.
+    """
+    dumpfile.seek(0, os.SEEK_END)
+    if dumpfile.tell() < resume_offset:
+        raise NANDError("Dump file is shorter than its journal says")
+
+    dumpfile.seek(0)
+    remaining = resume_offset
+    while digests and remaining:
+        chunk = dumpfile.read(min(remaining, 1 << 20))
+        for digest in digests:
+            digest.update(chunk)
+        remaining -= len(chunk)
+
+    dumpfile.seek(resume_offset)
+    dumpfile.truncate()
+
+
+def verify_checker(data: bytes, page_queue: queue.Queue, page_size_plus_ras: int,
+                   pages_per_block: int, mismatched: set, pool: BufferPool,
+                   errors: list):
+    """
+    Worker side of NANDFlasher.verify_blocks(): compare the (page, data)
+    pairs from the queue with the image until a None arrives, adding the
+    blocks that differ to mismatched and giving the buffers back to pool.
+    Errors, such as a container block failing its CRC, are recorded in
+    errors and the queue keeps being drained so the reader never blocks
+    on it.
+    """
+    while True:
+        item = page_queue.get()
+        if item is None:
+            return
+        page, page_data = item
+        try:
+            if errors:
+                continue
+            offset = page * page_size_plus_ras
+            if not same_data(page_data, data[offset:offset + page_size_plus_ras]):
+                mismatched.add(page // pages_per_block)
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+        finally:
+            pool.put(page_data)
+
+
+def dump_writer(dumpfile, page_queue: queue.Queue, digests, errors: list,
+                journal: Journal = None, first_block: int = 0,
+                pages_per_block: int = 1, pool: BufferPool = None,
+                ecc: "EccChecker" = None):
+    """
+    Disk side of NANDFlasher.dump(): write pages from the queue until a
+    None arrives, feeding them to the digests and the EccChecker along
+    the way and noting each completed block in the journal. Pages that
+    came from a pool are given back to it once written.
+    Errors are recorded in errors and the queue keeps being drained so
+    the reader never blocks on it.
+    """
+    written = 0
+    while True:
+        data = page_queue.get()
+        if data is None:
+            return
+        try:
+            if errors:
+                continue
+            dumpfile.write(data)
+            for digest in digests:
+                digest.update(data)
+            if ecc:
+                ecc.add(data)
+            written += 1
+            if journal and written % pages_per_block == 0:
+                dumpfile.flush()
+                journal.update(first_block + written // pages_per_block)
+        except OSError as exc:
+            errors.append(exc)
+        finally:
+            if pool is not None:
+                pool.put(data)
+
+
+# Number of blocks stream_blocks() reads ahead of the programming
+STREAM_QUEUE_DEPTH = 16
+# Image names that write/vwrite read with open_stream() ("-" is stdin)
+STREAM_SUFFIXES = (".gz", ".xz", ".zst")
+
+
+@contextmanager
+def open_stream(filename: str):
+    """
+    Open an image that is only read once from start to end, such as
+    stdin ("-") or a compressed file. gzip, xz and zstd data (zstd needs
+    the zstandard module) are recognised by their magic numbers and
+    decompressed as they are read. Yields a binary file object.
+    """
+    with ExitStack() as stack:
+        if filename == "-":
+            raw = sys.stdin.buffer
+        else:
+            raw = stack.enter_context(open(filename, "rb"))
+        head = raw.peek(6)[:6]
+        if head.startswith(b"\x1f\x8b"):
+            imagefile = stack.enter_context(gzip.GzipFile(fileobj=raw, mode="rb"))
+        elif head.startswith(b"\xfd7zXZ\x00"):
+            imagefile = stack.enter_context(lzma.LZMAFile(raw))
+        elif head.startswith(b"\x28\xb5\x2f\xfd"):
+            if zstandard is None:
+                raise ValueError(f"{filename} is zstd compressed, which needs the zstandard module")
+            imagefile = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(raw))
+        else:
+            imagefile = raw
+        yield imagefile
+
+
+class StreamedBlocks:
+    """
+    The blocks of an image that program_stream() still holds, as
+    {block: data}, sliced as if they were the raw image so that
+    verify_program() can check and rewrite them. A slice must lie
+    within one held block.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.blocks = {}
+
+    def __getitem__(self, index: slice):
+        block = index.start // self.block_size
+        base = block * self.block_size
+        return self.blocks[block][index.start - base:index.stop - base]
+
+
+def stream_blocks(imagefile, block_size: int, depth: int = STREAM_QUEUE_DEPTH):
+    """
+    Iterate over the blocks of an image read from a file object. A
+    producer thread reads (and so decompresses) up to depth blocks ahead
+    through a bounded queue, overlapping with the programming. The last
+    block is short if the image does not end on a block boundary.
+    Errors from reading are raised here once the blocks before them are
+    used up.
+    Closing the iterator early does not wait for the producer, which may
+    be stuck reading a pipe: it is a daemon thread and gives up at its
+    next read or queue put.
+    """
+    block_queue = queue.Queue(depth)
+    errors = []
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        "Queue item unless told to stop first."
+        while not stop.is_set():
+            try:
+                block_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer():
+        try:
+            while not stop.is_set():
+                block = imagefile.read(block_size)
+                # pipes and some decompressors return less than asked for
+                while block and len(block) < block_size:
+                    more = imagefile.read(block_size - len(block))
+                    if not more:
+                        break
+                    block += more
+                if not block or not put(block):
+                    break
+        except Exception as exc:  # pylint: disable=broad-except
+            errors.append(exc)
+        finally:
+            put(None)
+
+    reader = threading.Thread(target=producer, name="stream-reader", daemon=True)
+    reader.start()
+    try:
+        while True:
+            block = block_queue.get()
+            if block is None:
+                break
+            yield block
+        if errors:
+            raise errors[0]
+    finally:
+        stop.set()
+
+
+# where Manifest files are kept unless --manifest-dir says otherwise
+MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".nandway3", "manifests")
+
+CONTAINER_SUFFIX = ".nwc"
+CONTAINER_MAGIC = b"NWAYIMG1"
+CONTAINER_END_MAGIC = b"NWAYEND1"
+# magic, version, mf_id, device_id, page size, ras, pages per block, first block
+CONTAINER_HEADER = struct.Struct("<8sHBBIHII")
+# offset, stored length, raw length, crc32 of the raw data, kind
+CONTAINER_ENTRY = struct.Struct("<QIIIB")
+# index offset, number of blocks, end magic
+CONTAINER_FOOTER = struct.Struct("<QI8s")
+BLOCK_ERASED = 0
+BLOCK_ZLIB = 1
+BLOCK_STORED = 2
+
+
+def pack_block(block) -> tuple:
+    """
+    How a block is kept in a container, as (kind, payload): nothing for an
+    erased block, else zlib unless that does not make it smaller.
+    """
+    if same_data(b"\xff" * len(block), block):
+        return BLOCK_ERASED, b""
+    payload = zlib.compress(block)
+    if len(payload) < len(block):
+        return BLOCK_ZLIB, payload
+    return BLOCK_STORED, bytes(block)
+
+
+class ContainerWriter:
+    """
+    Writes an image container: a header with the chip ID and geometry,
+    then every block that is not erased, compressed on its own, then an
+    index with the position, size and CRC32 of each block and a footer
+    pointing at the index. Data is written with write() as a stream, like
+    to a raw file, or a block at a time with add_block().
+    The index is written by close().
+    """
+
+    def __init__(self, filename: str, page_size: int, ras: int, pages_per_block: int,
+                 mf_id: int = 0, device_id: int = 0, first_block: int = 0):
+        self.block_size = (page_size + ras) * pages_per_block
+        self.file = open(filename, "wb")
+        self.file.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, 1, mf_id, device_id,
+                                              page_size, ras, pages_per_block,
+                                              first_block))
+        self.pending = bytearray()
+        self.entries = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # leave the container without an index, so it is not mistaken
+            # for a complete image
+            self.file.close()
+
+    def write(self, data):
+        "Add data to the image, storing each block as soon as it is complete."
+        self.pending += data
+        start = 0
+        while len(self.pending) - start >= self.block_size:
+            self.add_block(self.pending[start:start + self.block_size])
+            start += self.block_size
+        del self.pending[:start]
+
+    def add_block(self, block, packed: tuple = None):
+        "Store a block, packed with pack_block() unless packed is given."
+        kind, payload = packed or pack_block(block)
+        self.entries.append((self.file.tell(), len(payload), len(block),
+                             zlib.crc32(block), kind))
+        self.file.write(payload)
+
+    def flush(self):
+        "Flush the blocks written so far to disk."
+        self.file.flush()
+
+    def close(self):
+        "Store what is left of the image, write the index and close the file."
+        if self.file.closed:
+            return
+        if self.pending:
+            self.add_block(bytes(self.pending))
+            self.pending.clear()
+        index_offset = self.file.tell()
+        for entry in self.entries:
+            self.file.write(CONTAINER_ENTRY.pack(*entry))
+        self.file.write(CONTAINER_FOOTER.pack(index_offset, len(self.entries),
+                                              CONTAINER_END_MAGIC))
+        self.file.close()
+
+
+class ImageContainer:
+    """
+    Read access to an image container in a buffer such as an mmap, as if
+    it were the raw image: len() and slicing work on the raw bytes, and
+    any block is found through the index without reading the others.
+    Blocks are checked against their CRC32 when they are unpacked.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        (magic, _, self.mf_id, self.device_id, self.page_size, self.ras,
+         self.pages_per_block, self.first_block) = CONTAINER_HEADER.unpack_from(buffer, 0)
+        index_offset, count, end_magic = CONTAINER_FOOTER.unpack_from(
+            buffer, len(buffer) - CONTAINER_FOOTER.size)
+        if magic != CONTAINER_MAGIC or end_magic != CONTAINER_END_MAGIC:
+            raise ValueError("Not a complete image container")
+
+        self.block_size = (self.page_size + self.ras) * self.pages_per_block
+        self.entries = [CONTAINER_ENTRY.unpack_from(buffer, index_offset + i*CONTAINER_ENTRY.size)
+                        for i in range(count)]
+        self.size = sum(entry[2] for entry in self.entries)
+        # the last block unpacked, as (block number, data)
+        self.cached = (-1, b"")
+
+    def __len__(self):
+        return self.size
+
+    def block(self, block: int) -> bytes:
+        "The raw data of a block of the image."
+        if self.cached[0] == block:
+            return self.cached[1]
+        offset, stored, size, crc, kind = self.entries[block]
+        if kind == BLOCK_ERASED:
+            data = b"\xff" * size
+        elif kind == BLOCK_ZLIB:
+            data = zlib.decompress(self.buffer[offset:offset + stored])
+        else:
+            data = bytes(self.buffer[offset:offset + stored])
+        if zlib.crc32(data) != crc:
+            raise ValueError(f"Block 0x{block:x} of the container fails its CRC check")
+        self.cached = (block, data)
+        return data
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            if index < 0:
+                index += self.size
+            return self.block(index // self.block_size)[index % self.block_size]
+
+        start, stop, _ = index.indices(self.size)
+        if stop <= start:
+            return b""
+        first, last = start // self.block_size, (stop - 1) // self.block_size
+        if first == last:
+            return self.block(first)[start - first*self.block_size:stop - first*self.block_size]
+        data = b"".join(self.block(block) for block in range(first, last + 1))
+        return data[start - first*self.block_size:stop - first*self.block_size]
+
+    def mismatch(self, chip: dict) -> str:
+        """
+        Why the image cannot be written to the chip described by
+        NANDFlasher.chip_state(), or "" if it can. The geometry must be the
+        chip's, and so must the ID unless none was recorded (0:0). The
+        image must start at block 0, as images are addressed by block.
+        """
+        if (self.mf_id or self.device_id) and (
+                (self.mf_id, self.device_id) != (chip["mf_id"], chip["device_id"])):
+            return (f"it is for chip {self.mf_id:02x}:{self.device_id:02x}, "
+                    f"not {chip['mf_id']:02x}:{chip['device_id']:02x}")
+        if (self.page_size, self.ras, self.pages_per_block) != (
+                chip["page_size"], chip["ras"], chip["pages_per_block"]):
+            return (f"it has {self.pages_per_block} pages of {self.page_size}+{self.ras} bytes "
+                    f"per block, the chip {chip['pages_per_block']} of "
+                    f"{chip['page_size']}+{chip['ras']}")
+        if self.first_block:
+            return (f"it holds a dump from block 0x{self.first_block:x} on; "
+                    "only images that start at block 0 can be written")
+        return ""
+
+    def blocks(self):
+        "Iterate over the raw data of every block."
+        return (self.block(block) for block in range(len(self.entries)))
+
+    def sha256(self) -> str:
+        "Hex SHA-256 of the raw image."
+        digest = hashlib.sha256()
+        for data in self.blocks():
+            digest.update(data)
+        return digest.hexdigest()
+
+
+def image_sha256(data) -> str:
+    "Hex SHA-256 of a raw image or an ImageContainer."
+    if isinstance(data, ImageContainer):
+        return data.sha256()
+    return hashlib.sha256(data).hexdigest()
+
+
+def pack_image(image, filename: str, page_size: int, ras: int, pages_per_block: int,
+               mf_id: int = 0, device_id: int = 0, workers: int = 0):
+    """
+    Convert a raw image to a container, compressing blocks on a pool of
+    threads. Returns the number of blocks stored.
+    """
+    block_size = (page_size + ras) * pages_per_block
+    blocks = [image[start:start + block_size] for start in range(0, len(image), block_size)]
+    workers = workers or os.cpu_count() or 1
+    with ContainerWriter(filename, page_size, ras, pages_per_block, mf_id, device_id) as writer, \
+            concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        # a bounded batch at a time, so the compressed image is never all in memory
+        batch_size = 4 * workers
+        for batch in range(0, len(blocks), batch_size):
+            chunk = blocks[batch:batch + batch_size]
+            for block, packed in zip(chunk, executor.map(pack_block, chunk)):
+                writer.add_block(block, packed)
+    return len(blocks)
+
+
+def unpack_image(container: ImageContainer, filename: str):
+    "Write the raw image held in a container to filename."
+    with open(filename, "wb") as rawfile:
+        for data in container.blocks():
+            rawfile.write(data)
+
+
+def diff_images(old, new, block_size: int, workers: int = 0) -> list:
+    """
+    Find the blocks of new that differ from old, hashing the blocks of
+    both images on a pool of threads (hashlib releases the GIL while it
+    hashes). Blocks past the end of old count as changed.
+    Returns the sorted list of block numbers.
+    """
+    def changed(block: int) -> bool:
+        start = block * block_size
+        old_block = old[start:start + block_size]
+        new_block = new[start:start + block_size]
+        return (len(old_block) != len(new_block)
+                or block_digest(old_block) != block_digest(new_block))
+
+    blocks = range(len(new) // block_size)
+    with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count() or 1) as executor:
+        return [block for block, differs in zip(blocks, executor.map(changed, blocks))
+                if differs]
+
+
+def write_diff_file(filename: str, blocks: list, block_size: int):
+    "Write a Diff-file for diffwrite: the offset of each block, one per line."
+    with open(filename, "w", encoding="ascii") as difffile:
+        for block in blocks:
+            difffile.write(f"0x{block*block_size:08x}\n")
+
+
+def coalesce_blocks(blocks) -> list:
+    "Sort and dedupe block numbers into runs of contiguous blocks, as (first, count)."
+    runs = []
+    for block in sorted(set(blocks)):
+        if runs and runs[-1][0] + runs[-1][1] == block:
+            runs[-1][1] += 1
+        else:
+            runs.append([block, 1])
+    return [tuple(run) for run in runs]
+
+
+@contextmanager
+def open_image(filename: str, containers: bool = True):
+    """
+    Map an image file into memory and yield a read-only memoryview of it.
+    Blocks and pages sliced from the view share the mapping instead of
+    being copied, and pages of the file are only read in when touched.
+    An image container is yielded as an ImageContainer instead, or
+    refused unless containers is True.
+    """
+    with open(filename, "rb") as imagefile:
+        if os.fstat(imagefile.fileno()).st_size == 0:
+            yield memoryview(b"")
+            return
+
+        image_map = mmap.mmap(imagefile.fileno(), 0, access=mmap.ACCESS_READ)
+        if image_map[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC:
+            if not containers:
+                image_map.close()
+                raise ValueError(f"{filename} is an image container, unpack it first")
+            try:
+                yield ImageContainer(image_map)
+            finally:
+                image_map.close()
+            return
+
+        if hasattr(image_map, "madvise"):
+            image_map.madvise(mmap.MADV_SEQUENTIAL)
+        image = memoryview(image_map)
+        try:
+            yield image
+        finally:
+            image.release()
+            try:
+                image_map.close()
+            except BufferError:
+                # a slice is still alive, the mapping goes away with it
+                pass
+
+
+def same_data(first: bytes, second) -> bool:
+    """
+    Compare a bytes or bytearray object with any bytes-like object.
+    Unlike ==, this stays a plain memcmp when second is a memoryview.
+    """
+    return len(first) == len(second) and first.startswith(second)
 
 
 def ps3_validate_block(block_data: bytes, page_plus_ras_sz: int, page_sz: int, blocknr: int):
@@ -499,10 +2708,536 @@ def ps3_validate_block(block_data: bytes, page_plus_ras_sz: int, page_sz: int, b
     return 1
 
 
-if __name__ == "__main__":
-    VERSION_MAJOR = 0
-    VERSION_MINOR = 65
+def badblock_markers(page_size: int, pages_per_block: int, convention: str = ""):
+    """
+    Where a chip keeps its factory bad block markers, as (pages, offset):
+    the pages of each block to check and the byte offset into their spare
+    area. The conventions are
+      "small"  byte 5 of the spare area of pages 0 and 1 (512-byte pages)
+      "large"  byte 0 of the spare area of pages 0 and 1 (2048+ byte pages)
+      "last"   byte 0 of the spare area of the last page of the block
+    With no convention, it is chosen from the page size.
+    """
+    if not convention:
+        convention = "small" if page_size <= 512 else "large"
+
+    if convention == "small":
+        return (0, 1), 5
+    if convention == "large":
+        return (0, 1), 0
+    if convention == "last":
+        return (pages_per_block - 1,), 0
+    raise ValueError(f"Unknown bad block marker convention: {convention}")
+
+
+def scan_badblocks(image, page_size: int, ras: int, pages_per_block: int,
+                   nblocks: int = 0, marker_pages: tuple = (0, 1),
+                   marker_offset: int = 0, skip_blocks: tuple = ()):
+    """
+    Find the blocks of a raw image whose bad block markers are not 0xFF.
+    With NumPy the image is viewed in place as a (block, page, byte) array
+    and the markers of all blocks are checked in one pass; otherwise the
+    marker bytes are checked one block at a time.
+    Returns the sorted list of bad block numbers.
+    """
+    page_size_plus_ras = page_size + ras
+    block_size_plus_ras = page_size_plus_ras * pages_per_block
+    if nblocks == 0 or nblocks > len(image) // block_size_plus_ras:
+        nblocks = len(image) // block_size_plus_ras
+
+    marker = page_size + marker_offset
+    if numpy is not None:
+        pages = numpy.frombuffer(image, dtype=numpy.uint8,
+                                 count=nblocks*block_size_plus_ras)
+        pages = pages.reshape(nblocks, pages_per_block, page_size_plus_ras)
+        markers = pages[:, list(marker_pages), marker]
+        bad_blocks = numpy.flatnonzero((markers != 0xFF).any(axis=1)).tolist()
+    else:
+        bad_blocks = [block for block in range(nblocks)
+                      if any(image[block*block_size_plus_ras + page*page_size_plus_ras + marker] != 0xFF
+                             for page in marker_pages)]
+
+    return [block for block in bad_blocks if block not in skip_blocks]
+
+
+ECC_SECTOR = 512
+# small pages carry a 3-byte SmartMedia ECC per 256-byte half, the first
+# half's at spare offset 13 and the second half's at 8
+SMALL_PAGE_ECC_SECTOR = 256
+SMALL_PAGE_ECC_OFFSETS = (13, 8)
+# parity of every byte value, for the ECC computations
+PARITY = bytes(bin(value).count("1") & 1 for value in range(256))
+# bits 0, 2, 4, 6 and bits 1, 3, 5, 7 of every byte value, packed together
+EVEN_BITS = bytes(sum(((value >> (2*bit)) & 1) << bit for bit in range(4)) for value in range(256))
+ODD_BITS = bytes(sum(((value >> (2*bit + 1)) & 1) << bit for bit in range(4)) for value in range(256))
+
+
+def ecc_layout(page_size: int, ras: int, ecc_offset: int = -1):
+    """
+    Where the ECC of a page is kept, as (sector size, spare offsets).
+    Large pages have a 4-byte ECC word per 512-byte sector, one after
+    the other from ecc_offset, by default 0x30 as on the Wii. 512-byte
+    pages have a 3-byte SmartMedia ECC per 256-byte half, at spare
+    offsets 13 and 8; ecc_offset does not apply to them.
+    """
+    if page_size == 512:
+        if ecc_offset >= 0:
+            raise ValueError("The ECC offset of 512-byte pages is fixed, leave out --ecc-offset")
+        if ras < 16:
+            raise ValueError(f"No room for the ECC of {page_size}+{ras} byte pages")
+        return SMALL_PAGE_ECC_SECTOR, SMALL_PAGE_ECC_OFFSETS
+    if page_size < 2048:
+        raise ValueError(f"No ECC layout is known for {page_size}-byte pages")
+    sectors = page_size // ECC_SECTOR
+    if ecc_offset < 0:
+        ecc_offset = 0x30
+    if ecc_offset + 4*sectors > ras:
+        raise ValueError(f"No room for the ECC of {page_size}+{ras} byte pages")
+    return ECC_SECTOR, tuple(ecc_offset + 4*sector for sector in range(sectors))
+
+
+def sector_ecc(sector) -> tuple:
+    """
+    Hamming ECC of one sector (512 or 256 bytes), as the (even, odd) pair
+    of parity words. Bit n of odd is the parity of the bits whose position
+    in the sector has bit n set, and even the same for the bits where it
+    is clear, so a single flipped bit shows up as its position in odd.
+    """
+    index_bits = len(sector).bit_length() - 1
+    lines = [[0, 0] for _ in range(3 + index_bits)]
+    for index, value in enumerate(sector):
+        for bit in range(index_bits):
+            lines[3 + bit][(index >> bit) & 1] ^= value
+    value = lines[3][0] ^ lines[3][1]
+    lines[0] = [value & 0x55, value & 0xaa]
+    lines[1] = [value & 0x33, value & 0xcc]
+    lines[2] = [value & 0x0f, value & 0xf0]
+
+    even = odd = 0
+    for bit, (even_bits, odd_bits) in enumerate(lines):
+        even |= PARITY[even_bits] << bit
+        odd |= PARITY[odd_bits] << bit
+    return even, odd
+
+
+def sectors_ecc(sectors):
+    """
+    sector_ecc() for an (n, 512) or (n, 256) NumPy array of sectors at
+    once. The sectors are folded 8 bytes at a time as uint64 words, so
+    each parity needs one pass over half the data instead of one per byte.
+    Returns the even and odd words as two arrays of n.
+    """
+    parity = numpy.frombuffer(PARITY, dtype=numpy.uint8).astype(numpy.uint16)
+    count, sector_size = sectors.shape
+    nwords = sector_size // 8
+    words = numpy.ascontiguousarray(sectors).view(numpy.uint64)
+    even = numpy.zeros(count, dtype=numpy.uint16)
+    odd = numpy.zeros(count, dtype=numpy.uint16)
+
+    def fold(selected):
+        "XOR the 8 bytes of each uint64 together."
+        return numpy.bitwise_xor.reduce(selected.view(numpy.uint8).reshape(count, 8), axis=1)
+
+    # lanes[:, k] is the XOR of the bytes whose index is k modulo 8
+    lanes = numpy.bitwise_xor.reduce(words, axis=1).view(numpy.uint8).reshape(count, 8)
+    value = numpy.bitwise_xor.reduce(lanes, axis=1)
+    for bit, (even_mask, odd_mask) in enumerate(((0x55, 0xaa), (0x33, 0xcc), (0x0f, 0xf0))):
+        even |= parity[value & even_mask] << bit
+        odd |= parity[value & odd_mask] << bit
+
+    for bit in range(sector_size.bit_length() - 1):
+        # XOR of the bytes whose index has bit `bit` set
+        if bit < 3:
+            ones = numpy.bitwise_xor.reduce(
+                lanes.reshape(count, 8 >> (bit + 1), 2, 1 << bit)[:, :, 1, :], axis=(1, 2))
+        else:
+            ones = fold(numpy.bitwise_xor.reduce(
+                words.reshape(count, nwords >> (bit - 2), 2, 1 << (bit - 3))[:, :, 1, :],
+                axis=(1, 2)))
+        even |= parity[value ^ ones] << (bit + 3)
+        odd |= parity[ones] << (bit + 3)
+    return even, odd
+
+
+def stored_ecc(stored, sector_size: int) -> tuple:
+    """
+    The (even, odd) parity words held in the ECC bytes of a sector, as
+    sector_ecc() computes them: stored is those bytes, or a sequence of
+    NumPy columns of them for many sectors at once.
+    A 512-byte sector's ECC word holds even and odd as two little-endian
+    12-bit values. A 256-byte SmartMedia ECC holds them inverted, with
+    the line parities interleaved (LP0, LP1, ...) in the first two bytes
+    and the column parities in bits 2-7 of the third.
+    """
+    if sector_size == ECC_SECTOR:
+        return stored[0] | ((stored[1] & 0xF) << 8), stored[2] | ((stored[3] & 0xF) << 8)
+    even_bits, odd_bits = EVEN_BITS, ODD_BITS
+    if numpy is not None and isinstance(stored[0], numpy.ndarray):
+        even_bits = numpy.frombuffer(EVEN_BITS, dtype=numpy.uint8).astype(numpy.uint16)
+        odd_bits = numpy.frombuffer(ODD_BITS, dtype=numpy.uint8).astype(numpy.uint16)
+    low, high, columns = (~stored[0] & 0xFF, ~stored[1] & 0xFF, (~stored[2] & 0xFF) >> 2)
+    even = even_bits[columns] | ((even_bits[low] | (even_bits[high] << 4)) << 3)
+    odd = odd_bits[columns] | ((odd_bits[low] | (odd_bits[high] << 4)) << 3)
+    return even, odd
+
+
+def check_ecc(image, page_size: int, ras: int, ecc_offset: int = -1,
+              first_page: int = 0) -> dict:
+    """
+    Check the ECC of every sector of a raw image of whole pages against
+    the ECC bytes in the spare areas (see ecc_layout()). Sectors whose
+    ECC bytes are erased (all 0xFF) are skipped. With NumPy the image is
+    checked a batch of pages at a time; otherwise one sector at a time.
+    Returns a dict with the counts of pages and sectors checked and lists
+    of the problems found, with page numbers counted from first_page:
+      "corrected"      (page, sector, byte, bit) of single flipped bits,
+                       the byte being its offset into the page
+      "ecc_errors"     (page, sector) where only the ECC bytes are damaged
+      "uncorrectable"  (page, sector) with more than one flipped bit
+    """
+    sector_size, offsets = ecc_layout(page_size, ras, ecc_offset)
+    width = 4 if sector_size == ECC_SECTOR else 3
+    sectors_per_page = len(offsets)
+    page_size_plus_ras = page_size + ras
+    npages = len(image) // page_size_plus_ras
+    report = {"pages": npages, "sectors": 0, "erased": 0,
+              "corrected": [], "ecc_errors": [], "uncorrectable": []}
+
+    if numpy is not None:
+        pages = numpy.frombuffer(image, dtype=numpy.uint8, count=npages*page_size_plus_ras)
+        pages = pages.reshape(npages, page_size_plus_ras)
+        for batch in range(0, npages, EccChecker.BATCH_PAGES):
+            chunk = pages[batch:batch + EccChecker.BATCH_PAGES]
+            stored = numpy.stack([chunk[:, page_size + offset:page_size + offset + width]
+                                  for offset in offsets], axis=1)
+            stored = stored.reshape(-1, width).astype(numpy.uint16)
+            erased = (stored == 0xFF).all(axis=1)
+            even, odd = sectors_ecc(chunk[:, :page_size].reshape(-1, sector_size))
+            stored_even, stored_odd = stored_ecc(stored.T, sector_size)
+            even ^= stored_even
+            odd ^= stored_odd
+            bad = numpy.flatnonzero(~erased & ((even | odd) != 0))
+            report["sectors"] += int((~erased).sum())
+            report["erased"] += int(erased.sum())
+            for index in bad.tolist():
+                classify_ecc(report, first_page + batch + index // sectors_per_page,
+                             index % sectors_per_page, int(even[index]), int(odd[index]),
+                             sector_size)
+        return report
+
+    for page in range(npages):
+        spare = page*page_size_plus_ras + page_size
+        for sector, offset in enumerate(offsets):
+            stored = image[spare + offset:spare + offset + width]
+            if stored == b"\xff" * width:
+                report["erased"] += 1
+                continue
+            report["sectors"] += 1
+            start = page*page_size_plus_ras + sector*sector_size
+            even, odd = sector_ecc(image[start:start + sector_size])
+            stored_even, stored_odd = stored_ecc(stored, sector_size)
+            even ^= stored_even
+            odd ^= stored_odd
+            if even | odd:
+                classify_ecc(report, first_page + page, sector, even, odd, sector_size)
+    return report
+
+
+def classify_ecc(report: dict, page: int, sector: int, even: int, odd: int,
+                 sector_size: int = ECC_SECTOR):
+    "Add a sector whose ECC syndrome (even, odd) is not zero to an ECC report."
+    mask = (1 << (sector_size.bit_length() + 2)) - 1
+    if bin(even | (odd << 12)).count("1") == 1:
+        report["ecc_errors"].append((page, sector))
+    elif even ^ odd == mask:
+        report["corrected"].append((page, sector, sector*sector_size + (odd >> 3), odd & 7))
+    else:
+        report["uncorrectable"].append((page, sector))
+
+
+def correct_ecc(image, report: dict, page_size: int, ras: int, first_page: int = 0):
+    "Flip back the bits an ECC report found flipped, in a writable image."
+    for page, _, byte, bit in report["corrected"]:
+        image[(page - first_page)*(page_size + ras) + byte] ^= 1 << bit
+
+
+def print_ecc_report(report: dict, limit: int = 32):
+    "Print what check_ecc() found, listing up to limit sectors of each kind."
+    for kind, label in (("corrected", "Corrected bit flip"),
+                        ("ecc_errors", "Damaged ECC"),
+                        ("uncorrectable", "Uncorrectable")):
+        for entry in report[kind][:limit]:
+            detail = f" byte=0x{entry[2]:x} bit={entry[3]}" if kind == "corrected" else ""
+            print(f"{label}: page=0x{entry[0]:x} sector={entry[1]}{detail}")
+        if len(report[kind]) > limit:
+            print(f"... and {len(report[kind]) - limit} more")
+    print(f"ECC: {report['sectors']} sectors checked ({report['erased']} erased),",
+          f"{len(report['corrected'])} correctable, {len(report['ecc_errors'])} bad ECC,",
+          f"{len(report['uncorrectable'])} uncorrectable")
+
+
+class EccChecker:
+    """
+    Checks the ECC of pages while they are dumped: pages are gathered
+    into batches that check_ecc() runs on a pool of worker threads, off
+    the path between the serial port and the disk.
+    """
+    BATCH_PAGES = 1024
+
+    def __init__(self, page_size: int, ras: int, ecc_offset: int = -1,
+                 workers: int = 0):
+        ecc_layout(page_size, ras, ecc_offset)
+        self.page_size = page_size
+        self.ras = ras
+        self.ecc_offset = ecc_offset
+        self.first_page = 0
+        self.batch = bytearray()
+        self.batch_first_page = 0
+        self.futures = []
+        self.report = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or os.cpu_count() or 1, thread_name_prefix="ecc")
+
+    def add(self, page_data):
+        "Queue a page for checking. Pages arrive in order from first_page."
+        if not self.batch:
+            self.batch_first_page = self.first_page
+        self.batch += page_data
+        self.first_page += 1
+        if len(self.batch) >= self.BATCH_PAGES * (self.page_size + self.ras):
+            self._submit()
+
+    def _submit(self):
+        self.futures.append(self.executor.submit(
+            check_ecc, bytes(self.batch), self.page_size, self.ras,
+            self.ecc_offset, self.batch_first_page))
+        self.batch.clear()
+
+    def finish(self) -> dict:
+        """
+        Wait for every batch and return the combined check_ecc() report.
+        The report is only built once; later calls return it as it is.
+        """
+        if self.report is not None:
+            return self.report
+        if self.batch:
+            self._submit()
+        report = {"pages": 0, "sectors": 0, "erased": 0,
+                  "corrected": [], "ecc_errors": [], "uncorrectable": []}
+        for future in self.futures:
+            for key, value in future.result().items():
+                report[key] += value
+        self.executor.shutdown()
+        self.report = report
+        return report
+
+    def replace_pages(self, pages: dict):
+        """
+        Check the ECC of {page: data} pages again, after finish(), and
+        put their results in the report in place of those for the data
+        that was first dumped for them.
+        """
+        for page, data in sorted(pages.items()):
+            fresh = check_ecc(data, self.page_size, self.ras, self.ecc_offset, page)
+            for kind in ("corrected", "ecc_errors", "uncorrectable"):
+                self.report[kind] = [entry for entry in self.report[kind]
+                                     if entry[0] != page] + fresh[kind]
+                self.report[kind].sort()
+
+
+class ConsistencyCheck:
+    """
+    Catches bad reads during a dump without dumping twice. In "reread"
+    mode every page is read twice in the pipeline, doubling the data
+    read, and pages whose reads differ are suspect; in "ecc" mode pages where the dump's EccChecker
+    finds any problem are, which is nearly free but blind to sectors
+    without ECC, such as erased ones. NANDFlasher.settle_pages() reads the
+    suspect pages again until they settle, and report says how it went:
+      "pages"     number of pages checked
+      "suspect"   pages that were read again
+      "settled"   {page: reads needed} of those that settled
+      "patched"   settled pages whose dumped data was wrong and replaced
+      "unstable"  pages that never read the same twice in a row
+    """
+    MODES = ("reread", "ecc")
+    # rounds of re-reads before a page is called unstable
+    RETRIES = 8
+
+    def __init__(self, mode: str, retries: int = RETRIES):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown consistency check '{mode}', use one of "
+                             + ", ".join(self.MODES))
+        self.mode = mode
+        self.retries = retries
+        self.suspect = []
+        self.report = {"mode": mode, "pages": 0, "suspect": [], "settled": {},
+                       "patched": [], "unstable": []}
+
+
+def print_consistency_report(report: dict, limit: int = 32):
+    "Print what a ConsistencyCheck found, listing up to limit pages of each kind."
+    for page in report["patched"][:limit]:
+        print(f"Bad read fixed: page=0x{page:x} settled after {report['settled'][page]} reads")
+    if len(report["patched"]) > limit:
+        print(f"... and {len(report['patched']) - limit} more")
+    for page in report["unstable"][:limit]:
+        print(f"Unstable: page=0x{page:x}")
+    if len(report["unstable"]) > limit:
+        print(f"... and {len(report['unstable']) - limit} more")
+    print(f"Consistency ({report['mode']}): {report['pages']} pages checked,",
+          f"{len(report['suspect'])} read again, {len(report['settled'])} settled",
+          f"({len(report['patched'])} patched), {len(report['unstable'])} unstable")
+
+
+def write_badblock_table(filename: str, bad_blocks: list, geometry: dict):
+    """
+    Write a bad block table as JSON: the geometry it was found with and
+    the list of bad blocks. A filename of "-" writes to stdout.
+    """
+    table = dict(geometry, bad_blocks=bad_blocks)
+    if filename == "-":
+        json.dump(table, sys.stdout, indent=2)
+        print()
+    else:
+        with open(filename, "w", encoding="utf-8") as tablefile:
+            json.dump(table, tablefile, indent=2)
+
+
+# user profiles read by resolve_regions() unless --profiles says otherwise
+PROFILES_FILE = os.path.join(os.path.expanduser("~"), ".nandway3", "profiles.json")
+
+# Named areas of the NAND in known consoles. A profile applies to chips
+# with one of its "MF:DEV" IDs (hex) and, if given, its block count.
+# Regions are [first block, block count]. User profiles in a JSON file
+# have the same shape.
+REGION_PROFILES = {
+    "wii": {
+        "ids": ["ec:dc", "ad:dc", "98:dc"],
+        "regions": {
+            "boot1": [0x0, 0x1],
+            "boot2": [0x1, 0x7],
+            "fs": [0x8, 0xFD8],
+            "superblocks": [0xFE0, 0x20],
+        },
+    },
+}
+
+
+def load_profiles(filename: str = "") -> dict:
+    """
+    The built-in REGION_PROFILES, plus the profiles in a JSON file, which
+    replace built-in ones of the same name.
+    """
+    profiles = dict(REGION_PROFILES)
+    if filename:
+        with open(filename, "r", encoding="utf-8") as profilefile:
+            profiles.update(json.load(profilefile))
+    return profiles
+
+
+def find_profile(profiles: dict, chip: dict, name: str = ""):
+    """
+    The (name, profile) for a chip described by NANDFlasher.chip_state():
+    the profile called name if one is given, otherwise the first one
+    whose IDs and block count fit. (None, None) if there is none.
+    """
+    for profile_name, profile in profiles.items():
+        if name:
+            if profile_name == name:
+                return profile_name, profile
+            continue
+        ids = {tuple(int(part, 16) for part in chip_id.split(":"))
+               for chip_id in profile.get("ids", ())}
+        if ((chip["mf_id"], chip["device_id"]) in ids and
+                profile.get("block_count", chip["block_count"]) == chip["block_count"]):
+            return profile_name, profile
+    return None, None
+
+
+def resolve_regions(chip: dict, names: str, profile_name: str = "",
+                    profiles_file: str = "") -> list:
+    """
+    The (name, first block, block count) regions named in a comma
+    separated list, from the chip's profile, in chip order.
+    Raises ValueError if there is no profile or a region is unknown or
+    does not fit on the chip.
+    """
+    if not profiles_file and os.path.exists(PROFILES_FILE):
+        profiles_file = PROFILES_FILE
+    profile_name, profile = find_profile(load_profiles(profiles_file), chip, profile_name)
+    if profile is None:
+        raise ValueError(f"No region profile for chip {chip['mf_id']:02x}:{chip['device_id']:02x}"
+                         " (see --profile and --profiles)")
+
+    regions = []
+    for name in names.split(","):
+        if name not in profile["regions"]:
+            raise ValueError(f"Profile {profile_name} has no region {name}, only "
+                             + ", ".join(profile["regions"]))
+        first, count = profile["regions"][name]
+        if first + count > chip["block_count"]:
+            raise ValueError(f"Region {name} (blocks {first:x}-{first+count-1:x}) is "
+                             f"outside the nand's {chip['block_count']:x} blocks")
+        regions.append((name, first, count))
+    return sorted(regions, key=lambda region: region[1])
+
+
+def region_blocks(regions: list) -> list:
+    "The blocks of (name, first block, block count) regions, ascending, each once."
+    return sorted({block for _, first, count in regions for block in range(first, first + count)})
+
+
+def split_options(args: list):
+    """
+    Split "--name" and "--name=value" options out of the command line.
+    Returns the remaining positional arguments and a dict of options.
+    """
+    positional = []
+    options = {}
+    for arg in args:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            positional.append(arg)
+    return positional, options
+
+
+# Options of every command that talks to a Teensy
+DEVICE_OPTIONS = ("progress", "metrics", "metrics-prom", "capture", "replay", "replay-timing")
+WRITE_OPTIONS = ("write-window", "no-skip-erased", "inline-verify", "board", "manifest-dir")
+REGION_OPTIONS = ("region", "profile", "profiles")
+# The options each command takes (plus DEVICE_OPTIONS for the Teensy commands)
+COMMAND_OPTIONS = {
+    "ps3badblocks": ("table",),
+    "scanbadblocks": ("page-size", "ras", "pages-per-block", "markers", "table"),
+    "ecccheck": ("page-size", "ras", "ecc-offset"),
+    "pack": ("page-size", "ras", "pages-per-block", "id"),
+    "unpack": (),
+    "diff": ("page-size", "ras", "pages-per-block"),
+    "info": ("profile", "profiles"),
+    "dump": ("window", "hash", "journal", "resume", "ecc", "ecc-offset", "consistency",
+             "consistency-report", "board", "manifest-dir") + REGION_OPTIONS,
+    "write": WRITE_OPTIONS + REGION_OPTIONS + ("smart", "journal", "resume"),
+    "vwrite": WRITE_OPTIONS + REGION_OPTIONS + ("smart", "journal", "resume"),
+    "diffwrite": WRITE_OPTIONS,
+    "vdiffwrite": WRITE_OPTIONS,
+    "badblocks": ("window", "markers", "table"),
+    "dualdump": ("window", "interleave"),
+    "bootloader": (),
+}
+
+
+def unknown_options(options: dict, accepted) -> list:
+    """
+    The options, as "--name", that are not among the accepted names.
+    Commands refuse these rather than ignore them, so that a mistyped
+    --resume does not quietly start over.
+    """
+    return [f"--{name}" for name in sorted(options) if name not in accepted]
 
+
+if __name__ == "__main__":
     # print "NANDway v%d.%02d - Teensy++ 2.0 NAND Flasher for PS3/Xbox/Wii"%(VERSION_MAJOR, VERSION_MINOR)
     print(
         f"NANDWay v{VERSION_MAJOR}.{VERSION_MINOR:02} - Teensy++ 2.0 NAND Flasher for PS3/Xbox/Wii")
@@ -510,7 +3245,9 @@ if __name__ == "__main__":
     print("(Original noralizer.py by Hector Martin \"marcan\" <hector@marcansoft.com>)")
     print()
 
-    if len(sys.argv) == 1:
+    argv, options = split_options(sys.argv)
+
+    if len(argv) == 1:
         print("""
         Usage:
         NANDway.py Serial-Port 0/1 Command
@@ -522,189 +3259,654 @@ if __name__ == "__main__":
              Displays information about NAND
           *  dump Filename [Offset] [Length]
              Dumps to Filename at [Offset] and [Length]
+          *  dualdump Filename0 Filename1 [Offset] [Length]
+             Dumps NAND0 to Filename0 and NAND1 to Filename1 in one session
+             (with --interleave: dualdump Filename [Offset] [Length] writes
+             one image alternating NAND0 and NAND1 pages; without it two
+             Filenames are required)
           *  vwrite/write Filename [Offset] [Length]
-             Flashes (v=verify) Filename at [Offset] and [Length]
+             Flashes (v=verify) Filename at [Offset] and [Length]. A
+             gzip, xz or zstd compressed Filename, or - for stdin, is
+             decompressed while it is written (no --resume or --region)
           *  vdiffwrite/diffwrite Filename Diff-file
-             Flashes (v=verify) Filename using a Diff-file
+             Flashes (v=verify) Filename using a Diff-file, in one pass over
+             the listed blocks in order
+          *  badblocks [Offset] [Length]
+             Identifies bad blocks on the NAND, reading only the pages
+             that hold bad block markers (see --markers and --table)
           *  ps3badblocks Filename
              Identifies bad blocks in Filename (raw dump)
+          *  scanbadblocks Filename
+             Identifies bad blocks in Filename (raw dump) of any geometry,
+             see --page-size, --ras, --pages-per-block and --markers
+          *  diff Old-file New-file Diff-file
+             Writes a Diff-file listing the blocks where New-file differs
+             from Old-file, see --page-size, --ras and --pages-per-block
+          *  pack Filename Container-file
+             Converts a raw dump to an image container, see --page-size,
+             --ras, --pages-per-block and --id
+          *  unpack Container-file Filename
+             Converts an image container back to the raw dump
+          *  ecccheck Filename [Fixed-file]
+             Checks the ECC of every sector in Filename (raw dump) and
+             optionally writes a copy with single bit flips corrected,
+             see --page-size, --ras and --ecc-offset
           *  bootloader
              Enters Teensy's bootloader mode (for Teensy reprogramming)
 
+             dump, write and vwrite take --region=NAME[,NAME...] instead
+             of [Offset] [Length] to work on named regions of the chip's
+             profile (see info) in one session. The regions sit at their
+             own offsets in Filename, as in a full dump.
+
              Notes: 1) All offsets and lengths are in hex (number of blocks)
                     2) The Diff-file is a file which lists all the changed
                        offsets of a dump file. This will increase flashing
                        time dramatically.
+                    3) Dumping to a Filename ending in .nwc writes an image
+                       container: chip ID, geometry, per-block CRC32, erased
+                       blocks left out and the others compressed, with an
+                       index. write/vwrite/diffwrite read containers directly.
 
         Examples:
           NANDway.py COM1 0 info
           NANDway.py COM1 0 dump d:\\myflash.bin
           NANDway.py COM1 1 dump d:\\myflash.bin 3d a0
+          NANDway.py COM1 0 dualdump d:\\nand0.bin d:\\nand1.bin
           NANDway.py COM1 0 write d:\\myflash.bin
           NANDway.py COM3 1 write d:\\myflash.bin 20 1c
           NANDway.py COM3 0 vwrite d:\\myflash.bin
           NANDway.py COM3 1 vwrite d:\\myflash.bin 8d 20
+          NANDway.py COM1 0 dump d:\\wii_boot.bin --region=boot1,boot2
           NANDway.py COM4 0 diffwrite d:\\myflash.bin d:\\myflash_diff.txt
           NANDway.py COM3 1 vdiffwrite d:\\myflash.bin d:\\myflash_diff.txt
+          NANDway.py COM1 0 badblocks --table=d:\\badblocks.json
           NANDway.py COM1 0 bootloader
           NANDway.py ps3badblocks d:\\myflash.bin
+          NANDway.py scanbadblocks d:\\xbox.bin --page-size=512 --pages-per-block=32
+          NANDway.py ecccheck d:\\wii.bin d:\\wii_fixed.bin
+          NANDway.py diff d:\\myflash.bin d:\\patched.bin d:\\myflash_diff.txt
+          NANDway.py pack d:\\myflash.bin d:\\myflash.nwc
+
+        Options:
+          --window=N   Number of page reads kept in flight while dumping
+                       (default 8, 1 = wait for every page)
+          --hash=NAME[,NAME...]
+                       Hash the dump while it is written, e.g. --hash=sha256,md5
+          --write-window=N
+                       Number of page writes kept in flight while writing
+                       (default: sized from the Teensy's free memory)
+          --no-skip-erased
+                       Also send pages that are entirely 0xFF when writing
+                       (they are skipped by default, as erasing sets them)
+          --inline-verify
+                       With vwrite, read each block back straight after
+                       writing it instead of verifying the whole range in
+                       one pass at the end (failed blocks are then rewritten)
+          --smart      Read each block before writing it and only erase and
+                       program the blocks that differ from the file
+          --board=LABEL
+                       Keep a manifest of block hashes for the board called
+                       LABEL: dump and vwrite record what is on the chip, and
+                       write/vwrite/diffwrite skip blocks that the manifest
+                       says already hold their data, without reading them
+          --manifest-dir=Directory
+                       Where manifests are kept (default ~/.nandway3/manifests)
+          --region=NAME[,NAME...]
+                       Dump or write only the named regions (a region dump
+                       takes no --hash, --ecc, --consistency or --journal)
+          --profile=NAME
+                       Use the named region profile instead of the one that
+                       matches the chip ID
+          --profiles=File
+                       JSON file of region profiles to add to the built-in
+                       ones (default ~/.nandway3/profiles.json if present):
+                       {"name": {"ids": ["ec:dc"], "block_count": 4096,
+                                 "regions": {"boot": [0, 8]}}}
+                       (block_count is optional and is the count info shows)
+          --journal[=Directory]
+                       Record progress in a journal so an interrupted
+                       dump/write/vwrite can be resumed. Journals go in
+                       Directory if one is given; otherwise dump journals
+                       go next to the dump and write journals in
+                       ~/.nandway3/journals
+          --resume     Continue an interrupted dump/write/vwrite from the
+                       last completed block recorded in its journal
+          --page-size=N, --ras=N, --pages-per-block=N
+                       Geometry of the dump for scanbadblocks, ecccheck, diff
+                       and pack (decimal, default 2048, page size / 32 and 64)
+          --id=MF:DEV  Chip ID to record with pack, in hex
+          --markers=small|large|last
+                       Where the bad block markers are: spare byte 5 or 0 of
+                       the first two pages, or spare byte 0 of the last page
+                       (default: small for 512-byte pages, large otherwise)
+          --table=File Also write the bad block table as JSON ("-" = stdout)
+          --ecc        Check the ECC of the pages while dumping
+          --consistency=reread|ecc
+                       Catch bad reads while dumping: read every page twice
+                       in a row (reread, which reads twice as much over the
+                       link and makes the dump up to twice as slow), or take
+                       pages that fail the ECC check as suspect (ecc, nearly
+                       free but blind to erased sectors). There is no
+                       default mode. Suspect pages are read again
+                       until they read the same twice, and fixed in the
+                       dump; pages that never do are reported as unstable
+          --consistency-report=File
+                       Also write the consistency results as JSON to File
+          --ecc-offset=N
+                       Offset of the 4-byte ECC words of each 512-byte
+                       sector in the spare area (default 0x30). 512-byte
+                       pages use SmartMedia ECC at spare bytes 8 and 13
+                       instead and take no --ecc-offset
+          --progress=auto|tty|json|none
+                       How to show progress: a line redrawn twice a second
+                       with speed and ETA (tty), one JSON object per update
+                       (json) or nothing (none). auto = tty on a terminal,
+                       none otherwise
+          --metrics=File
+                       Write per-command latency histograms, bytes on the
+                       wire, status and retry counts to File as JSON
+          --metrics-prom=File
+                       Write the same metrics as a Prometheus textfile
+          --capture=File
+                       Record everything sent to and received from the
+                       Teensy, with timestamps, to File
+          --replay=File
+                       Run against a trace recorded with --capture instead
+                       of a Teensy (Serial-Port is ignored); the command
+                       must send exactly what was captured
+          --replay-timing
+                       With --replay, deliver the responses at the times
+                       they were captured instead of at full speed
         """)
         sys.exit(0)
 
-    if (len(sys.argv) == 3) and (sys.argv[1] == "ps3badblocks"):
+    if argv[1] in COMMAND_OPTIONS:
+        accepted = COMMAND_OPTIONS[argv[1]]
+    else:
+        accepted = DEVICE_OPTIONS + COMMAND_OPTIONS.get(argv[3] if len(argv) > 3 else "", ())
+    unknown = unknown_options(options, accepted)
+    if unknown:
+        print(f"Error: unknown option for this command: {', '.join(unknown)}")
+        sys.exit(1)
+
+    if (len(argv) == 3) and (argv[1] in ("ps3badblocks", "scanbadblocks")):
         tStart = time.time()
 
-        with open(sys.argv[2], "rb") as datafile:
-            data = datafile.read()
+        if argv[1] == "ps3badblocks":
+            page_sz = 2048
+            ras_sz = 64
+            pages_per_block = 64
+            nblocks = 1024
+            marker_pages, marker_offset = badblock_markers(page_sz, pages_per_block)
+            skip_blocks = (0x1FF,)
+        else:
+            page_sz = int(options.get("page-size") or 2048)
+            ras_sz = int(options.get("ras") or page_sz // 32)
+            pages_per_block = int(options.get("pages-per-block") or 64)
+            nblocks = 0
+            marker_pages, marker_offset = badblock_markers(
+                page_sz, pages_per_block, options.get("markers", ""))
+            skip_blocks = ()
+
+        with open_image(argv[2], containers=False) as data:
+            bad_blocks = scan_badblocks(data, page_sz, ras_sz, pages_per_block, nblocks,
+                                        marker_pages, marker_offset, skip_blocks)
+            if nblocks == 0:
+                nblocks = len(data) // ((page_sz+ras_sz)*pages_per_block)
+
+        for pgblock in bad_blocks:
+            # print "Invalid block: %d (0x%X)"%(pgblock, pgblock)
+            print(f"Invalid block: {pgblock} (0x{pgblock:X})")
+        print(f"{len(bad_blocks)} of {nblocks} blocks are bad")
+
+        if options.get("table"):
+            write_badblock_table(options["table"], bad_blocks, {
+                "page_size": page_sz,
+                "ras": ras_sz,
+                "pages_per_block": pages_per_block,
+                "block_count": nblocks,
+                "marker_pages": list(marker_pages),
+                "marker_offset": marker_offset,
+            })
 
-        datasize = len(data)
-        page_sz = 2048
-        page_plus_ras_sz = 2112
-        nblocks = 1024
-        pages_per_block = 64
-        block = 0
-        block_plus_ras_sz = page_plus_ras_sz*pages_per_block
-        block_offset = 0
+        print()
+        # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
+        print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+        sys.exit(0)
 
+    if (len(argv) in (3, 4)) and (argv[1] == "ecccheck"):
         tStart = time.time()
 
-        while block < nblocks:
-            pgblock = block+block_offset
-
-            block_data = data[pgblock*(block_plus_ras_sz):(pgblock+1)*(block_plus_ras_sz)]
-            block_valid = ps3_validate_block(
-                block_data, page_plus_ras_sz, page_sz, block)
-            if block_valid == 0:
-                print()
-                # print "Invalid block: %d (0x%X)"%(pgblock, pgblock)
-                print(f"Invalid block: {pgblock} (0x{pgblock:X})")
-                print()
+        page_sz = int(options.get("page-size") or 2048)
+        ras_sz = int(options.get("ras") or page_sz // 32)
+        ecc_offset = int(options.get("ecc-offset") or "-1", 0)
 
-            # print "\r%d KB / %d KB"%(((block+1)*(block_plus_ras_sz))/1024, (nblocks*(block_plus_ras_sz))/1024),
-            bblock_progress = ((block+1)*(block_plus_ras_sz))/1024
-            bblock_total = (nblocks*(block_plus_ras_sz))/1024
-            print(f"{bblock_progress} KB / {bblock_total} KB", end="\r")
-            sys.stdout.flush()
+        try:
+            with open_image(argv[2], containers=False) as data:
+                report = check_ecc(data, page_sz, ras_sz, ecc_offset)
+        except ValueError as exc:
+            print(f"Error: {exc}")
+            sys.exit(1)
+        print_ecc_report(report)
 
-            block += 1
+        if len(argv) == 4:
+            shutil.copyfile(argv[2], argv[3])
+            with open(argv[3], "r+b") as fixedfile, \
+                    mmap.mmap(fixedfile.fileno(), 0) as fixed:
+                correct_ecc(fixed, report, page_sz, ras_sz)
+            print(f"Wrote {argv[3]} with {len(report['corrected'])} bit flips corrected")
 
         print()
-        # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
         print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
-        sys.exit(0)
+        sys.exit(0 if not report["uncorrectable"] else 1)
 
-    n = NANDFlasher(sys.argv[1], int(sys.argv[2], 10),
-                    VERSION_MAJOR, VERSION_MINOR)
-    print("Pinging Teensy...")
-    freeram = n.ping()
-    # print "Available memory: %d bytes"%(freeram)
-    print(f"Available memory: {freeram} bytes")
-    print()
+    if (len(argv) == 4) and (argv[1] in ("pack", "unpack")):
+        tStart = time.time()
+
+        if argv[1] == "pack":
+            page_sz = int(options.get("page-size") or 2048)
+            ras_sz = int(options.get("ras") or page_sz // 32)
+            pages_per_block = int(options.get("pages-per-block") or 64)
+            mf_id, device_id = (int(part, 16) for part in (options.get("id") or "0:0").split(":"))
+            with open_image(argv[2], containers=False) as data:
+                nblocks = pack_image(data, argv[3], page_sz, ras_sz, pages_per_block,
+                                     mf_id, device_id)
+            print(f"Packed {nblocks:x} blocks: {os.path.getsize(argv[2])} bytes",
+                  f"-> {os.path.getsize(argv[3])} bytes")
+        else:
+            with open_image(argv[2]) as data:
+                if not isinstance(data, ImageContainer):
+                    print(f"Error: {argv[2]} is not an image container")
+                    sys.exit(1)
+                unpack_image(data, argv[3])
+            print(f"Unpacked {os.path.getsize(argv[3])} bytes")
 
-    tStart = time.time()
-    if len(sys.argv) in (5, 6, 7) and sys.argv[3] == "dump":
-        n.printstate()
-        print()
-        print("Dumping...")
-        sys.stdout.flush()
         print()
+        print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+        sys.exit(0)
 
-        block_offset = 0
-        nblocks = 0
+    if (len(argv) == 5) and (argv[1] == "diff"):
+        tStart = time.time()
 
-        if len(sys.argv) == 6:
-            block_offset = int(sys.argv[5], 16)
-        elif len(sys.argv) == 7:
-            block_offset = int(sys.argv[5], 16)
-            nblocks = int(sys.argv[6], 16)
+        page_sz = int(options.get("page-size") or 2048)
+        ras_sz = int(options.get("ras") or page_sz // 32)
+        pages_per_block = int(options.get("pages-per-block") or 64)
+        block_size = (page_sz + ras_sz) * pages_per_block
 
-        n.dump(sys.argv[4], block_offset, nblocks)
+        with open_image(argv[2]) as old_data, open_image(argv[3]) as new_data:
+            changed = diff_images(old_data, new_data, block_size)
+            nblocks = len(new_data) // block_size
+        write_diff_file(argv[4], changed, block_size)
+        print(f"{len(changed):x} of {nblocks:x} blocks differ,",
+              f"in {len(coalesce_blocks(changed)):x} runs")
 
         print()
-        # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
         print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+        sys.exit(0)
 
-    if len(sys.argv) == 4 and sys.argv[3] == "info":
-        n.printstate()
+    transport = None
+    if options.get("replay"):
+        transport = ReplaySerial(options["replay"], "replay-timing" in options)
+    n = NANDFlasher(argv[1], int(argv[2], 10),
+                    VERSION_MAJOR, VERSION_MINOR,
+                    transport, options.get("capture", ""))
+    n.progress = Progress(options.get("progress") or "auto")
+    try:
+        print("Pinging Teensy...")
+        freeram = n.ping()
+        # print "Available memory: %d bytes"%(freeram)
+        print(f"Available memory: {freeram} bytes")
         print()
 
-    elif len(sys.argv) in (5, 6, 7) and (sys.argv[3] == "write" or sys.argv[3] == "vwrite"):
-        n.printstate()
-        print()
+        tStart = time.time()
+        if len(argv) in (5, 6, 7) and argv[3] == "dump":
+            n.printstate()
+            print()
+            print("Dumping...")
+            sys.stdout.flush()
+            print()
 
-        print("Writing...")
-        sys.stdout.flush()
+            block_offset = 0
+            nblocks = 0
+
+            if len(argv) == 6:
+                block_offset = int(argv[5], 16)
+            elif len(argv) == 7:
+                block_offset = int(argv[5], 16)
+                nblocks = int(argv[6], 16)
+
+            window = int(options.get("window") or NANDFlasher.READ_WINDOW)
+            hashes = tuple(name for name in options.get("hash", "").split(",") if name)
+
+            regions = []
+            if options.get("region"):
+                try:
+                    regions = resolve_regions(n.chip_state(), options["region"],
+                                              options.get("profile", ""), options.get("profiles", ""))
+                except (ValueError, OSError) as exc:
+                    print(f"Error: {exc}")
+                    sys.exit(1)
+                if len(argv) > 5 or argv[4].endswith(CONTAINER_SUFFIX):
+                    print("Error: --region takes the place of Offset and Length,",
+                          "and does not dump to a container")
+                    sys.exit(1)
+                unsupported = [f"--{name}" for name in ("hash", "ecc", "consistency", "journal", "resume")
+                               if name in options]
+                if unsupported:
+                    print(f"Error: {', '.join(unsupported)} cannot be used with --region")
+                    sys.exit(1)
+
+            journal = ""
+            if "journal" in options or "resume" in options:
+                journal = journal_path(argv[4], options.get("journal", ""))
+
+            ecc = None
+            if "ecc" in options or options.get("consistency") == "ecc":
+                try:
+                    ecc = EccChecker(n.nand_page_size, n.nand_ras,
+                                     int(options.get("ecc-offset") or "-1", 0))
+                except ValueError as exc:
+                    print(f"Error: {exc}")
+                    sys.exit(1)
+            consistency = None
+            if "consistency" in options:
+                if argv[4].endswith(CONTAINER_SUFFIX):
+                    print("Error: --consistency needs a plain dump file")
+                    sys.exit(1)
+                try:
+                    consistency = ConsistencyCheck(options["consistency"])
+                except ValueError as exc:
+                    print(f"Error: {exc}")
+                    sys.exit(1)
+
+            if regions:
+                for name, first, count in regions:
+                    print(f"  {name:<12} blocks {first:x}-{first+count-1:x}")
+                n.dump_regions(argv[4], regions, window)
+                digests = {}
+            else:
+                digests = n.dump(argv[4], block_offset, nblocks, window, hashes,
+                                 journal, "resume" in options, ecc, consistency)
+
+            if options.get("board"):
+                manifest = Manifest(options.get("manifest-dir") or MANIFEST_DIR,
+                                    options["board"], n.chip_state())
+                block_size = n.nand_block_size_plus_ras
+                with open_image(argv[4]) as image:
+                    if regions:
+                        for block in region_blocks(regions):
+                            manifest.record(block, image[block*block_size:(block+1)*block_size])
+                    else:
+                        manifest.record_image(image, block_offset, block_size)
+                manifest.save()
 
-        print()
+            print()
+            for name, digest in digests.items():
+                print(f"{name}: {digest}")
+            if ecc:
+                print_ecc_report(ecc.finish())
+            if consistency:
+                print_consistency_report(consistency.report)
+                if options.get("consistency-report"):
+                    with open(options["consistency-report"], "w", encoding="utf-8") as reportfile:
+                        json.dump(consistency.report, reportfile, indent=2)
+            # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
+            print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+
+        if len(argv) == 4 and argv[3] == "info":
+            n.printstate()
+            try:
+                profiles = load_profiles(options.get("profiles") or (
+                    PROFILES_FILE if os.path.exists(PROFILES_FILE) else ""))
+            except (ValueError, OSError) as exc:
+                print(f"Error: {exc}")
+                sys.exit(1)
+            profile_name, profile = find_profile(profiles, n.chip_state(), options.get("profile", ""))
+            if profile:
+                print(f"Regions ({profile_name} profile):")
+                for name, (first, count) in sorted(profile["regions"].items(),
+                                                   key=lambda region: region[1][0]):
+                    print(f"  {name:<12} blocks {first:x}-{first+count-1:x}")
+            print()
 
-        with open(sys.argv[4], "rb") as datafile:
-            data = datafile.read()
+        elif len(argv) in (5, 6, 7) and (argv[3] == "write" or argv[3] == "vwrite"):
+            n.printstate()
+            print()
 
-        block_offset = 0
-        nblocks = 0
+            print("Writing...")
+            sys.stdout.flush()
 
-        if (sys.argv[3] == "vwrite"):
-            verify = True
-        else:
-            verify = False
+            print()
 
-        if len(sys.argv) == 6:
-            block_offset = int(sys.argv[5], 16)
-        elif len(sys.argv) == 7:
-            block_offset = int(sys.argv[5], 16)
-            nblocks = int(sys.argv[6], 16)
+            block_offset = 0
+            nblocks = 0
 
-        n.program(data, verify, block_offset, nblocks)
+            if (argv[3] == "vwrite"):
+                verify = True
+            else:
+                verify = False
+
+            if len(argv) == 6:
+                block_offset = int(argv[5], 16)
+            elif len(argv) == 7:
+                block_offset = int(argv[5], 16)
+                nblocks = int(argv[6], 16)
+
+            window = int(options.get("write-window") or 0)
+            skip_erased = "no-skip-erased" not in options
+            smart = "smart" in options
+            manifest = None
+            if options.get("board"):
+                manifest = Manifest(options.get("manifest-dir") or MANIFEST_DIR,
+                                    options["board"], n.chip_state())
+
+            regions = []
+            if options.get("region"):
+                try:
+                    regions = resolve_regions(n.chip_state(), options["region"],
+                                              options.get("profile", ""), options.get("profiles", ""))
+                except (ValueError, OSError) as exc:
+                    print(f"Error: {exc}")
+                    sys.exit(1)
+                if len(argv) > 5:
+                    print("Error: --region takes the place of Offset and Length")
+                    sys.exit(1)
+
+            if argv[4] == "-" or argv[4].endswith(STREAM_SUFFIXES):
+                if regions or "resume" in options:
+                    print("Error: --region and --resume need an uncompressed image file")
+                    sys.exit(1)
+                try:
+                    with open_stream(argv[4]) as imagefile:
+                        result = n.program(stream_blocks(imagefile, n.nand_block_size_plus_ras),
+                                           verify, block_offset, nblocks, window, skip_erased,
+                                           smart, inline_verify="inline-verify" in options,
+                                           manifest=manifest)
+                except (ValueError, OSError, EOFError, lzma.LZMAError) as exc:
+                    print(f"Error reading {argv[4]}: {exc}")
+                    sys.exit(1)
+            else:
+                with open_image(argv[4]) as data:
+                    if regions:
+                        blocks = region_blocks(regions)
+                        if (blocks[-1]+1)*n.nand_block_size_plus_ras > len(data):
+                            print(f"Error: block {blocks[-1]:x} is outside the file")
+                            sys.exit(1)
+                        print(f"Writing {len(blocks):x} blocks in {len(regions)} regions:")
+                        for name, first, count in regions:
+                            print(f"  {name:<12} blocks {first:x}-{first+count-1:x}")
+                        result = n.program_blocks(data, blocks, verify, window, skip_erased, smart,
+                                                  inline_verify="inline-verify" in options,
+                                                  manifest=manifest)
+                    else:
+                        journal = ""
+                        if "journal" in options or "resume" in options:
+                            journal = journal_path(argv[4], options.get("journal") or JOURNAL_DIR)
+                        result = n.program(data, verify, block_offset, nblocks, window,
+                                           skip_erased, smart, journal, "resume" in options,
+                                           "inline-verify" in options, manifest,
+                                           image_file_key(argv[4]))
 
-        print()
-        # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
-        print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+            print()
+            if result == -1:
+                sys.exit(1)
+            # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
+            print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
 
-    elif len(sys.argv) == 6 and (sys.argv[3] == "diffwrite" or sys.argv[3] == "vdiffwrite"):
-        n.printstate()
-        print()
-        print("Writing using diff file ...")
-        sys.stdout.flush()
-        print()
+        elif len(argv) == 6 and (argv[3] == "diffwrite" or argv[3] == "vdiffwrite"):
+            n.printstate()
+            print()
+            print("Writing using diff file ...")
+            sys.stdout.flush()
+            print()
 
-        with open(sys.argv[4], "rb") as datafile:
-            data = datafile.read()
-        with open(sys.argv[5], "rb") as difffile:
-            diff_data = difffile.readlines()
+            with open(argv[5], "rb") as difffile:
+                diff_data = [line for line in difffile.readlines() if line.strip()]
 
-        block_offset = 0
-        nblocks = 0
-        nlines = len(diff_data)
-        cur_line = 0
+            if (argv[3] == "vdiffwrite"):
+                verify = True
+            else:
+                verify = False
+
+            window = int(options.get("write-window") or 0)
+            skip_erased = "no-skip-erased" not in options
+            manifest = None
+            if options.get("board"):
+                manifest = Manifest(options.get("manifest-dir") or MANIFEST_DIR,
+                                    options["board"], n.chip_state())
+
+            blocks = []
+            for line in diff_data:
+                addr = int(line, 16)
+                if addr % n.nand_block_size_plus_ras:
+                    # print "Error: incorrect address for block addr=%x. addresses must be on a per-block boundary"%(addr)
+                    print(
+                        f"Error: incorrect address for block addr={addr:x}. addresses must be on a per-block boundary")
+                    sys.exit(0)
+                blocks.append(addr // n.nand_block_size_plus_ras)
+
+            # one pass over the changed blocks in order, however the file lists them
+            runs = coalesce_blocks(blocks)
+            blocks = sorted(set(blocks))
+            print(f"Programming {len(blocks):x} blocks from {len(diff_data)} lines",
+                  f"in {len(runs):x} runs:")
+            for first, count in runs:
+                print(f"  blocks {first:x}-{first+count-1:x}")
+
+            with open_image(argv[4]) as data:
+                if blocks and (blocks[-1] >= n.nand_block_count or
+                               (blocks[-1]+1)*n.nand_block_size_plus_ras > len(data)):
+                    print(f"Error: block {blocks[-1]:x} is outside the file or the nand")
+                    sys.exit(0)
+                result = n.program_blocks(data, blocks, verify, window, skip_erased,
+                                          inline_verify="inline-verify" in options,
+                                          manifest=manifest)
 
-        if (sys.argv[3] == "vdiffwrite"):
-            verify = True
-        else:
-            verify = False
-
-        for line in diff_data:
-            addr = int(line[2:], 16)
-            if addr % n.nand_block_size_plus_ras:
-                # print "Error: incorrect address for block addr=%x. addresses must be on a per-block boundary"%(addr)
-                print(
-                    f"Error: incorrect address for block addr={addr:x}. addresses must be on a per-block boundary")
-                sys.exit(0)
-
-            block_offset = int(addr/n.nand_block_size_plus_ras)
-            # print "Programming offset %x block %x (%d/%d)"%(addr, block_offset, cur_line+1, nlines)
-            print(
-                f"Programming offset {addr:x} block {block_offset:x} ({cur_line+1}/{nlines})")
-            n.program(data, verify, block_offset, True)
-            cur_line += 1
+            print()
+            if result == -1:
+                sys.exit(1)
+            # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
+            print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
 
-        print()
-        # print "Done. [%s]"%(datetime.timedelta(seconds=time.time() - tStart))
-        print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+        elif len(argv) in (4, 5, 6) and argv[3] == "badblocks":
+            n.printstate()
+            print()
+            print("Scanning for bad blocks...")
+            sys.stdout.flush()
+            print()
 
-    elif len(sys.argv) == 4 and sys.argv[3] == "bootloader":
-        print()
-        print("Entering Teensy's bootloader mode... Goodbye!")
-        n.bootloader()
-        sys.exit(0)
+            block_offset = 0
+            nblocks = 0
+
+            if len(argv) == 5:
+                block_offset = int(argv[4], 16)
+            elif len(argv) == 6:
+                block_offset = int(argv[4], 16)
+                nblocks = int(argv[5], 16)
+
+            window = int(options.get("window") or NANDFlasher.READ_WINDOW)
+            convention = options.get("markers", "")
 
-    n.ping()
+            suspect_blocks = []
+            bad_blocks = n.badblocks(block_offset, nblocks, convention, window, suspect_blocks)
+
+            print()
+            for pgblock in bad_blocks:
+                print(f"Invalid block: {pgblock} (0x{pgblock:X})")
+            for pgblock in suspect_blocks:
+                print(f"Suspect block: {pgblock} (0x{pgblock:X}), markers unreadable")
+            print(f"{len(bad_blocks)} bad blocks found, {len(suspect_blocks)} suspect")
+
+            if options.get("table"):
+                marker_pages, marker_offset = badblock_markers(
+                    n.nand_page_size, n.nand_pages_per_block, convention)
+                write_badblock_table(options["table"], bad_blocks, {
+                    "mf_id": n.mf_id,
+                    "device_id": n.device_id,
+                    "page_size": n.nand_page_size,
+                    "ras": n.nand_ras,
+                    "pages_per_block": n.nand_pages_per_block,
+                    "block_count": n.nand_block_count,
+                    "marker_pages": list(marker_pages),
+                    "marker_offset": marker_offset,
+                    "suspect_blocks": suspect_blocks,
+                })
+
+            print()
+            print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+
+        elif len(argv) >= 5 and argv[3] == "dualdump":
+            # --interleave alone decides whether one or two files are written
+            nfiles = 1 if "interleave" in options else 2
+            filenames = argv[4:4+nfiles]
+            range_args = argv[4+nfiles:]
+            if len(filenames) < nfiles or len(range_args) > 2:
+                print("Error: dualdump takes Filename0 Filename1 [Offset] [Length], or",
+                      "Filename [Offset] [Length] with --interleave")
+                sys.exit(1)
+            if nfiles == 2 and all(char in "0123456789abcdefABCDEF" for char in filenames[1]):
+                print(f"Error: {filenames[1]} looks like an Offset, not a second Filename",
+                      "(give --interleave to dump both NANDs into one file)")
+                sys.exit(1)
+
+            other = n.companion()
+            n.printstate()
+            print()
+            other.printstate()
+            print()
+            print("Dumping NAND0 and NAND1...")
+            sys.stdout.flush()
+            print()
+
+            block_offset = 0
+            nblocks = 0
+
+            if len(range_args) >= 1:
+                block_offset = int(range_args[0], 16)
+            if len(range_args) == 2:
+                nblocks = int(range_args[1], 16)
+
+            window = int(options.get("window") or NANDFlasher.READ_WINDOW)
+
+            n.dump_dual(other, filenames, block_offset, nblocks, window)
+
+            print()
+            print(f"Done. [{datetime.timedelta(seconds=time.time() - tStart)}]")
+
+        elif len(argv) == 4 and argv[3] == "bootloader":
+            print()
+            print("Entering Teensy's bootloader mode... Goodbye!")
+            n.bootloader()
+            sys.exit(0)
+
+        n.ping()
+    finally:
+        # failed runs are the ones whose metrics and traces matter most
+        if options.get("metrics"):
+            n.metrics.write_json(options["metrics"])
+        if options.get("metrics-prom"):
+            n.metrics.write_prometheus(options["metrics-prom"],
+                                       {"port": argv[1], "nand": argv[2]})
+        if n.trace:
+            n.trace.close()
@@ -0,0 +1,433 @@
+#!/usr/bin/python
+# *************************************************************************
+#  NANDway3_emu.py - NANDWay Teensy firmware emulator on a pseudo-terminal
+#
+# This code is licensed to you under the terms of the GNU GPL, version 2;
+# see file COPYING or http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt
+# *************************************************************************
+
+import os
+import sys
+import pty
+import tty
+import time
+import mmap
+import random
+import select
+from collections import deque
+
+from NANDway3 import NANDFlasher, split_options, unknown_options, VERSION_MAJOR, VERSION_MINOR
+
+FAULT_STATUSES = "TVPR"
+FAULT_COMMANDS = ("read", "write", "erase")
+
+
+class EmulatedNAND:
+    """
+    One NAND chip, backed by an mmap'd image in the layout of a dump:
+    pages of page_size+ras bytes, block after block.
+    The image is created, erased, if it does not exist yet.
+    """
+
+    def __init__(self, filename: str, page_size: int, ras: int, pages_per_block: int,
+                 block_count: int, mf_id: int, device_id: int):
+        self.page_size = page_size
+        self.ras = ras
+        self.page_size_plus_ras = page_size + ras
+        self.pages_per_block = pages_per_block
+        self.mf_id = mf_id
+        self.device_id = device_id
+
+        block_size_plus_ras = self.page_size_plus_ras * pages_per_block
+        if not block_count:
+            if not os.path.exists(filename):
+                raise ValueError(f"{filename} does not exist, give --blocks to create it")
+            block_count = os.path.getsize(filename) // block_size_plus_ras
+        self.block_count = block_count
+
+        size = block_count * block_size_plus_ras
+        with open(filename, "ab") as imagefile:
+            missing = size - imagefile.tell()
+            while missing > 0:
+                imagefile.write(b"\xff" * min(missing, block_size_plus_ras))
+                missing -= block_size_plus_ras
+        with open(filename, "r+b") as imagefile:
+            self.image = mmap.mmap(imagefile.fileno(), size)
+
+    def id_bytes(self):
+        "The 25 bytes the firmware sends after 'Y' for an ID command."
+        block_size = self.page_size * self.pages_per_block
+        return (bytes((self.mf_id, self.device_id, 0, 0, 0))
+                + self.page_size.to_bytes(4, "big")
+                + self.ras.to_bytes(2, "big")
+                + bytes((8,))
+                + block_size.to_bytes(4, "big")
+                + self.block_count.to_bytes(4, "big")
+                + bytes((1,))
+                + (block_size * self.block_count).to_bytes(4, "big"))
+
+    def has_page(self, page: int):
+        "Whether page is on the chip."
+        return page < self.block_count * self.pages_per_block
+
+    def _page_range(self, page: int):
+        return page * self.page_size_plus_ras, (page + 1) * self.page_size_plus_ras
+
+    def read(self, page: int):
+        "Read a page, data and spare area."
+        start, end = self._page_range(page)
+        return self.image[start:end]
+
+    def program(self, page: int, data: bytes):
+        "Program a page. Like a real NAND, bits can only go from 1 to 0."
+        start, end = self._page_range(page)
+        programmed = (int.from_bytes(self.image[start:end], "little")
+                      & int.from_bytes(data, "little"))
+        self.image[start:end] = programmed.to_bytes(len(data), "little")
+
+    def erase(self, page: int):
+        "Erase the block holding page."
+        first_page = page - page % self.pages_per_block
+        start = self._page_range(first_page)[0]
+        size = self.page_size_plus_ras * self.pages_per_block
+        self.image[start:start + size] = b"\xff" * size
+
+    def close(self):
+        "Write the image back and unmap it."
+        self.image.flush()
+        self.image.close()
+
+
+class FaultInjector:
+    """
+    Decides which commands fail and with which status byte.
+    faults lists STATUS:COMMAND:PAGE entries that always fail, rates lists
+    STATUS:COMMAND:PROBABILITY entries that fail at random, both comma
+    separated. STATUS is one of T, V, P or R, COMMAND one of read, write
+    or erase and PAGE the page address of the command in hex.
+    """
+
+    def __init__(self, faults: str = "", rates: str = "", seed: int = 0):
+        self.pages = {}
+        self.rates = []
+        self.random = random.Random(seed)
+        for status, command, page in self._parse(faults):
+            self.pages[(command, int(page, 16))] = status
+        for status, command, rate in self._parse(rates):
+            self.rates.append((command, float(rate), status))
+
+    @staticmethod
+    def _parse(specs: str):
+        for spec in filter(None, specs.split(",")):
+            fields = spec.split(":")
+            if (len(fields) != 3 or fields[0] not in FAULT_STATUSES
+                    or fields[1] not in FAULT_COMMANDS):
+                raise ValueError(f"Bad fault: {spec}")
+            yield fields
+
+    def status(self, command: str, page: int):
+        "The status byte command on page fails with, or None if it succeeds."
+        status = self.pages.get((command, page))
+        if status:
+            return status.encode()
+        for rate_command, rate, status in self.rates:
+            if rate_command == command and self.random.random() < rate:
+                return status.encode()
+        return None
+
+
+class EmulatedTeensy:
+    """
+    A Teensy running NANDWay firmware, served on a pty.
+    Commands are handled in order like the firmware does. Each response
+    is held back until the chip would have finished the operation (tR,
+    tPROG or tBERS), the data would have crossed the USB link at usb_rate
+    bytes/s and usb_latency has passed, so the host sees realistic timing.
+    """
+    # Seconds the firmware waits for the rest of a WRITEPAGE before 'R'
+    RX_TIMEOUT = 1.0
+
+    def __init__(self, nands: list, faults: FaultInjector, t_read: float = 0.0,
+                 t_prog: float = 0.0, t_erase: float = 0.0, usb_latency: float = 0.0,
+                 usb_rate: float = 0.0, free_ram: int = 4096):
+        self.nands = nands
+        self.faults = faults
+        self.t_read = t_read
+        self.t_prog = t_prog
+        self.t_erase = t_erase
+        self.usb_latency = usb_latency
+        self.usb_rate = usb_rate
+        self.free_ram = free_ram
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.name = os.ttyname(self.slave)
+
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        # responses not yet due, as (due time, data)
+        self.pending = deque()
+        self.busy_until = 0.0
+        self.partial_since = None
+        self.commands = 0
+        self.running = True
+
+    def fileno(self):
+        "The pty master, for select()."
+        return self.master
+
+    def respond(self, data: bytes, now: float, busy: float = 0.0):
+        """
+        Queue a response, after busy seconds of chip time and the time to
+        send data over USB.
+        """
+        transfer = len(data) / self.usb_rate if self.usb_rate else 0.0
+        self.busy_until = max(now, self.busy_until) + busy + transfer
+        self.pending.append((self.busy_until + self.usb_latency, data))
+
+    def receive(self, now: float):
+        "Read what the host sent and handle every complete command in it."
+        try:
+            data = os.read(self.master, 65536)
+        except (BlockingIOError, OSError):
+            return
+        self.inbuf += data
+        self.process(now)
+
+    def process(self, now: float):
+        "Handle the complete commands at the start of the input buffer."
+        while self.inbuf and self.running:
+            cmd = self.inbuf[0]
+            nand = self.nands[1 if cmd >= NANDFlasher.CMD_NAND1_ID else 0]
+
+            if cmd in (NANDFlasher.CMD_PING1, NANDFlasher.CMD_PING2,
+                       NANDFlasher.CMD_BOOTLOADER, NANDFlasher.CMD_IO_LOCK,
+                       NANDFlasher.CMD_IO_RELEASE, NANDFlasher.CMD_PULLUPS_DISABLE,
+                       NANDFlasher.CMD_PULLUPS_ENABLE, NANDFlasher.CMD_NAND0_ID,
+                       NANDFlasher.CMD_NAND1_ID):
+                del self.inbuf[:1]
+                self.commands += 1
+                if cmd == NANDFlasher.CMD_PING1:
+                    self.respond(bytes((VERSION_MAJOR, VERSION_MINOR)), now)
+                elif cmd == NANDFlasher.CMD_PING2:
+                    self.respond(self.free_ram.to_bytes(2, "big"), now)
+                elif cmd == NANDFlasher.CMD_BOOTLOADER:
+                    print(f"{self.name}: entering bootloader, goodbye")
+                    self.running = False
+                elif cmd in (NANDFlasher.CMD_NAND0_ID, NANDFlasher.CMD_NAND1_ID):
+                    self.respond(b"Y" + nand.id_bytes() if nand else b"N", now)
+                continue
+
+            if cmd not in (NANDFlasher.CMD_NAND0_READPAGE, NANDFlasher.CMD_NAND1_READPAGE,
+                           NANDFlasher.CMD_NAND0_WRITEPAGE, NANDFlasher.CMD_NAND1_WRITEPAGE,
+                           NANDFlasher.CMD_NAND0_ERASEBLOCK, NANDFlasher.CMD_NAND1_ERASEBLOCK):
+                print(f"{self.name}: ignoring unknown command 0x{cmd:02x}")
+                del self.inbuf[:1]
+                continue
+
+            if len(self.inbuf) < 4:
+                return
+            page = self.inbuf[1] | (self.inbuf[2] << 8) | (self.inbuf[3] << 16)
+
+            if cmd in (NANDFlasher.CMD_NAND0_WRITEPAGE, NANDFlasher.CMD_NAND1_WRITEPAGE):
+                # a missing NAND still gets a whole page sent to it, as big as the
+                # other NAND's pages, which must be consumed to stay in sync
+                size = 4 + next(chip.page_size_plus_ras for chip in (nand, *self.nands)
+                                if chip)
+                if len(self.inbuf) < size:
+                    # wait for the rest of the page, like the firmware
+                    if self.partial_since is None:
+                        self.partial_since = now
+                    return
+                data = bytes(self.inbuf[4:size])
+                del self.inbuf[:size]
+                self.partial_since = None
+                self.commands += 1
+                status = (self.faults.status("write", page)
+                          if nand and nand.has_page(page) else b"T")
+                if status is None:
+                    nand.program(page, data)
+                self.respond(status or b"K", now, self.t_prog)
+
+            elif cmd in (NANDFlasher.CMD_NAND0_READPAGE, NANDFlasher.CMD_NAND1_READPAGE):
+                del self.inbuf[:4]
+                self.commands += 1
+                status = (self.faults.status("read", page)
+                          if nand and nand.has_page(page) else b"T")
+                self.respond(status or b"K" + nand.read(page), now, self.t_read)
+
+            else:
+                del self.inbuf[:4]
+                self.commands += 1
+                status = (self.faults.status("erase", page)
+                          if nand and nand.has_page(page) else b"T")
+                if status is None:
+                    nand.erase(page)
+                self.respond(status or b"K", now, self.t_erase)
+
+    def check_rx_timeout(self, now: float):
+        "Give up on a WRITEPAGE whose payload stopped arriving, with 'R'."
+        if self.partial_since is not None and now - self.partial_since > self.RX_TIMEOUT:
+            print(f"{self.name}: receive timeout, dropping {len(self.inbuf)} bytes")
+            self.inbuf.clear()
+            self.partial_since = None
+            self.respond(b"R", now)
+
+    def release(self, now: float):
+        "Move the responses that are due to the output buffer."
+        while self.pending and self.pending[0][0] <= now:
+            self.outbuf += self.pending.popleft()[1]
+
+    def send(self):
+        "Write as much of the output buffer to the pty as it takes."
+        try:
+            written = os.write(self.master, self.outbuf)
+        except (BlockingIOError, OSError):
+            return
+        del self.outbuf[:written]
+
+    def next_deadline(self):
+        "When something next needs doing without input from the host."
+        deadlines = []
+        if self.pending:
+            deadlines.append(self.pending[0][0])
+        if self.partial_since is not None:
+            deadlines.append(self.partial_since + self.RX_TIMEOUT)
+        return min(deadlines) if deadlines else None
+
+    def close(self):
+        "Close the pty and the chip images."
+        os.close(self.master)
+        os.close(self.slave)
+        for nand in self.nands:
+            if nand:
+                nand.close()
+
+
+def serve(teensys: list):
+    "Serve the emulated Teensys until they are all gone or Ctrl-C."
+    teensys = list(teensys)
+    try:
+        while teensys:
+            deadlines = [deadline for deadline in map(EmulatedTeensy.next_deadline, teensys)
+                         if deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            writers = [teensy for teensy in teensys if teensy.outbuf]
+            readable, writable, _ = select.select(teensys, writers, [], timeout)
+
+            now = time.monotonic()
+            for teensy in readable:
+                teensy.receive(now)
+            for teensy in teensys:
+                teensy.check_rx_timeout(now)
+                teensy.release(now)
+                if teensy.outbuf and (teensy in writable or teensy not in writers):
+                    teensy.send()
+
+            for teensy in [teensy for teensy in teensys
+                           if not teensy.running and not teensy.outbuf]:
+                teensy.close()
+                teensys.remove(teensy)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for teensy in teensys:
+            print(f"{teensy.name}: {teensy.commands} commands served")
+            teensy.close()
+
+
+def main():
+    "Start the emulated Teensys the command line asks for."
+    argv, options = split_options(sys.argv)
+    if len(argv) not in (2, 3):
+        print("""
+        Usage:
+        NANDway3_emu.py NAND0-image [NAND1-image] [options]
+
+          Emulates a Teensy running NANDWay firmware on a pseudo-terminal and
+          prints its name, to be used as the Serial-Port of NANDway3.py.
+          The images hold the chips' contents in the layout of a dump and
+          are created, erased, if they do not exist.
+
+        Options:
+          --page-size=N, --ras=N, --pages-per-block=N, --blocks=N
+                       Geometry of the chips (decimal, default 2048, page
+                       size / 32, 64 and the size of an existing image)
+          --id=MF:DEV  Manufacturer and device ID in hex (default ec:f1)
+          --free-ram=N Free memory reported by ping (default 4096)
+          --t-read=US, --t-prog=US, --t-erase=US
+                       Chip busy time for a page read, a page program and a
+                       block erase in microseconds (default 25, 200, 2000)
+          --usb-latency=US
+                       Delay before each response reaches the host in
+                       microseconds (default 1000)
+          --usb-rate=KB/s
+                       Speed of the USB link (default 1000, 0 = unlimited)
+          --no-timing  Answer as fast as possible, ignoring all of the above
+          --fault=STATUS:COMMAND:PAGE[,...]
+                       Always fail COMMAND (read, write or erase) on PAGE (hex)
+                       with STATUS (T, V, P or R)
+          --fault-rate=STATUS:COMMAND:PROBABILITY[,...]
+                       Fail COMMAND at random with STATUS
+          --seed=N     Seed for --fault-rate (default 0)
+          --count=N    Emulate N Teensys, using Image.0 ... Image.N-1
+          --link=Path  Also make Path a symlink to the pty (with --count,
+                       Path.0 ... Path.N-1)
+
+        Example:
+          NANDway3_emu.py nand0.bin --blocks=1024 --link=/tmp/ttyNAND
+          NANDway3.py /tmp/ttyNAND 0 dump dump.bin
+        """)
+        sys.exit(0)
+
+    unknown = unknown_options(options, (
+        "page-size", "ras", "pages-per-block", "blocks", "id", "free-ram", "t-read", "t-prog",
+        "t-erase", "usb-latency", "usb-rate", "no-timing", "fault", "fault-rate", "seed",
+        "count", "link"))
+    if unknown:
+        print(f"Error: unknown option for this command: {', '.join(unknown)}")
+        sys.exit(1)
+
+    page_size = int(options.get("page-size") or 2048)
+    ras = int(options.get("ras") or page_size // 32)
+    pages_per_block = int(options.get("pages-per-block") or 64)
+    block_count = int(options.get("blocks") or 0)
+    mf_id, device_id = (int(part, 16) for part in (options.get("id") or "ec:f1").split(":"))
+    faults = FaultInjector(options.get("fault", ""), options.get("fault-rate", ""),
+                           int(options.get("seed") or 0))
+
+    timing = {}
+    if "no-timing" not in options:
+        timing = {
+            "t_read": int(options.get("t-read") or 25) / 1e6,
+            "t_prog": int(options.get("t-prog") or 200) / 1e6,
+            "t_erase": int(options.get("t-erase") or 2000) / 1e6,
+            "usb_latency": int(options.get("usb-latency") or 1000) / 1e6,
+            "usb_rate": float(options.get("usb-rate") or 1000) * 1024,
+        }
+
+    count = int(options.get("count") or 0)
+    teensys = []
+    for index in range(max(count, 1)):
+        suffix = f".{index}" if count else ""
+        nands = [EmulatedNAND(filename + suffix, page_size, ras, pages_per_block,
+                              block_count, mf_id, device_id)
+                 for filename in argv[1:]]
+        if len(nands) == 1:
+            nands.append(None)
+        teensy = EmulatedTeensy(nands, faults, free_ram=int(options.get("free-ram") or 4096),
+                                **timing)
+        if options.get("link"):
+            link = options["link"] + suffix
+            if os.path.islink(link):
+                os.remove(link)
+            os.symlink(teensy.name, link)
+        print(teensy.name, flush=True)
+        teensys.append(teensy)
+
+    serve(teensys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# *************************************************************************
+#  NANDway3_farm.py - run NANDway3 jobs on many Teensy flashers at once
+#
+# This code is licensed to you under the terms of the GNU GPL, version 2;
+# see file COPYING or http://www.gnu.org/licenses/old-licenses/gpl-2.0.txt
+# *************************************************************************
+
+import os
+import sys
+import time
+import json
+import datetime
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from NANDway3 import (NANDFlasher, NANDError, TeensySerialError, open_image,
+                      split_options, unknown_options, journal_path, image_file_key,
+                      JOURNAL_DIR, VERSION_MAJOR, VERSION_MINOR)
+
+OPERATIONS = ("info", "dump", "write", "vwrite")
+
+
+class FarmFlasher(NANDFlasher):
+    "NANDFlasher that sends its progress to the farm instead of stdout."
+    # Seconds between progress messages sent to the farm
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, port: str, nand_id: int, status_queue):
+        super().__init__(port, nand_id, VERSION_MAJOR, VERSION_MINOR)
+        self.port = port
+        self.status_queue = status_queue
+        self.last_report = 0.0
+        self.bytes_done = 0
+
+    def report_progress(self, done: int, total: int):
+        self.bytes_done = done
+        now = time.monotonic()
+        if done < total and now - self.last_report < self.PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        self.status_queue.put((self.port, "progress", done, total))
+
+
+def parse_jobs(filename: str):
+    """
+    Read a job list. Each line holds the arguments of one NANDway3 run,
+        Serial-Port 0/1 Command [Filename] [Offset] [Length]
+    where Command is info, dump, write or vwrite and Offset and Length are
+    in hex blocks. Blank lines and anything after a # are ignored.
+    """
+    jobs = []
+    with open(filename, "r", encoding="utf-8") as jobfile:
+        for lineno, line in enumerate(jobfile, 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if (len(fields) < 3 or len(fields) > 6 or fields[2] not in OPERATIONS or
+                    (fields[2] != "info" and len(fields) < 4)):
+                raise ValueError(f"{filename}:{lineno}: bad job: {line.strip()}")
+
+            jobs.append({
+                "line": lineno,
+                "port": fields[0],
+                "nand_id": int(fields[1], 10),
+                "operation": fields[2],
+                "filename": fields[3] if len(fields) > 3 else "",
+                "block_offset": int(fields[4], 16) if len(fields) > 4 else 0,
+                "nblocks": int(fields[5], 16) if len(fields) > 5 else 0,
+            })
+    return jobs
+
+
+def run_job(job: dict, status_queue, resume: bool):
+    "Run one job on its device. Returns the number of bytes transferred."
+    flasher = FarmFlasher(job["port"], job["nand_id"], status_queue)
+    try:
+        print(f"Available memory: {flasher.ping()} bytes")
+        flasher.printstate()
+
+        if job["operation"] == "dump":
+            flasher.dump(job["filename"], job["block_offset"], job["nblocks"],
+                         journal=job["filename"] + ".journal", resume=resume)
+        elif job["operation"] in ("write", "vwrite"):
+            with open_image(job["filename"]) as data:
+                if flasher.program(data, job["operation"] == "vwrite",
+                                   job["block_offset"], job["nblocks"],
+                                   journal=journal_path(job["filename"], JOURNAL_DIR),
+                                   resume=resume,
+                                   image_key=image_file_key(job["filename"])) == -1:
+                    raise NANDError("Write failed, see the log")
+    finally:
+        flasher.close()
+
+    return flasher.bytes_done
+
+
+def run_device(port: str, jobs: list, status_queue, log_dir: str, resume: bool):
+    """
+    Worker process: run every job for one device in order, logging the
+    flasher's own output to a file per device.
+    Returns a result dict for each job.
+    """
+    results = []
+    log_name = port.strip("/\\").replace("/", "_").replace("\\", "_") + ".log"
+    with open(os.path.join(log_dir, log_name), "a", encoding="utf-8") as log, \
+            contextlib.redirect_stdout(log):
+        for job in jobs:
+            status_queue.put((port, "start", job["operation"], job["filename"]))
+            print(f"=== {datetime.datetime.now()} {job['operation']} {job['filename']}")
+            result = dict(job, ok=False, error="", bytes=0, seconds=0.0)
+            start = time.monotonic()
+            try:
+                result["bytes"] = run_job(job, status_queue, resume)
+                result["ok"] = True
+            except (NANDError, TeensySerialError, OSError, ValueError) as exc:
+                result["error"] = str(exc)
+            except SystemExit:
+                result["error"] = f"flasher gave up, see {log_name}"
+            result["seconds"] = time.monotonic() - start
+            print(f"=== {'OK' if result['ok'] else 'FAILED ' + result['error']}")
+            status_queue.put((port, "done", result["ok"], result["error"]))
+            results.append(result)
+
+    return results
+
+
+class StatusView:
+    """
+    One status line per device. On a terminal the lines are redrawn in
+    place; otherwise only job starts and ends are printed.
+    """
+
+    def __init__(self, ports: list):
+        self.ports = ports
+        self.status = {port: "waiting" for port in ports}
+        self.is_tty = sys.stdout.isatty()
+        self.drawn = False
+
+    def update(self, message: tuple):
+        "Apply a status message from a worker."
+        port, kind = message[0], message[1]
+        if kind == "progress":
+            done, total = message[2], message[3]
+            self.status[port] = (f"{self.status[port].split(' [')[0]} "
+                                 f"[{done/1024:.0f} / {total/1024:.0f} KB, "
+                                 f"{100*done/max(total, 1):.1f}%]")
+            return
+        if kind == "start":
+            self.status[port] = f"{message[2]} {message[3]}"
+        else:
+            self.status[port] = "finished" if message[2] else f"FAILED: {message[3]}"
+        if not self.is_tty:
+            print(f"{port}: {self.status[port]}")
+
+    def draw(self):
+        "Redraw the status lines on a terminal."
+        if not self.is_tty:
+            return
+        if self.drawn:
+            sys.stdout.write(f"\x1b[{len(self.ports)}F")
+        for port in self.ports:
+            sys.stdout.write(f"\x1b[K{port:<16} {self.status[port]}\n")
+        sys.stdout.flush()
+        self.drawn = True
+
+
+def print_report(results: list, elapsed: float):
+    "Print the per-job results and the farm's total throughput."
+    print()
+    print(f"{'Port':<16} {'NAND':<4} {'Operation':<9} {'Result':<6} "
+          f"{'Time':>10} {'KB/s':>9}  File")
+    for result in results:
+        rate = result["bytes"] / 1024 / result["seconds"] if result["seconds"] else 0
+        print(f"{result['port']:<16} {result['nand_id']:<4} {result['operation']:<9} "
+              f"{'OK' if result['ok'] else 'FAIL':<6} "
+              f"{result['seconds']:>9.1f}s {rate:>9.1f}  {result['filename']}")
+        if result["error"]:
+            print(f"    {result['error']}")
+
+    total_bytes = sum(result["bytes"] for result in results)
+    failed = sum(1 for result in results if not result["ok"])
+    print()
+    print(f"{len(results)} jobs, {failed} failed, {total_bytes/1024:.0f} KB in "
+          f"{datetime.timedelta(seconds=round(elapsed))} "
+          f"({total_bytes/1024/max(elapsed, 1e-9):.1f} KB/s overall)")
+
+
+def main():
+    "Run a job list across all the devices it names."
+    argv, options = split_options(sys.argv)
+    if len(argv) != 2:
+        print("""
+        Usage:
+        NANDway3_farm.py Job-file [--log-dir=Directory] [--report=File] [--resume]
+
+          Job-file  One job per line:
+                      Serial-Port 0/1 Command [Filename] [Offset] [Length]
+                    with Command one of info, dump, write or vwrite.
+                    Jobs for different ports run in parallel, jobs for the
+                    same port run one after another.
+
+          --log-dir=Directory  Where to write each device's log (default .)
+          --report=File        Also write the results as JSON to File
+          --resume             Resume interrupted dumps/writes from their journals
+
+        Example job file:
+          /dev/ttyACM0 0 dump   board1_nand0.bin
+          /dev/ttyACM1 0 vwrite golden.bin
+          /dev/ttyACM1 1 vwrite golden.bin 20 1c
+        """)
+        sys.exit(0)
+
+    unknown = unknown_options(options, ("log-dir", "report", "resume"))
+    if unknown:
+        print(f"Error: unknown option for this command: {', '.join(unknown)}")
+        sys.exit(1)
+
+    jobs = parse_jobs(argv[1])
+    by_port = {}
+    for job in jobs:
+        by_port.setdefault(job["port"], []).append(job)
+
+    log_dir = options.get("log-dir") or "."
+    resume = "resume" in options
+    view = StatusView(list(by_port))
+    results = []
+    start = time.monotonic()
+
+    with multiprocessing.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=len(by_port)) as pool:
+        status_queue = manager.Queue()
+        futures = {pool.submit(run_device, port, port_jobs, status_queue, log_dir, resume): port
+                   for port, port_jobs in by_port.items()}
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            while not status_queue.empty():
+                view.update(status_queue.get())
+            view.draw()
+            for future in finished:
+                try:
+                    results.extend(future.result())
+                except Exception as exc:  # pylint: disable=broad-except
+                    for job in by_port[futures[future]]:
+                        results.append(dict(job, ok=False, error=f"worker died: {exc}",
+                                            bytes=0, seconds=0.0))
+
+    elapsed = time.monotonic() - start
+    results.sort(key=lambda result: result["line"])
+    print_report(results, elapsed)
+
+    if options.get("report"):
+        with open(options["report"], "w", encoding="utf-8") as reportfile:
+            json.dump({"elapsed": elapsed, "jobs": results}, reportfile, indent=2)
+
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"Image containers: lossless round trips and the checks made before writing one."
+import os
+
+import NANDway3
+
+PAGE, RAS, PAGES = 512, 16, 4
+BLOCK = (PAGE + RAS) * PAGES
+CHIP = {"mf_id": 0xEC, "device_id": 0x75, "page_size": PAGE, "ras": RAS,
+        "pages_per_block": PAGES, "block_count": 16}
+
+
+def make_image(nblocks: int) -> bytes:
+    "Random blocks with every third one erased."
+    return b"".join(b"\xff" * BLOCK if block % 3 == 0 else os.urandom(BLOCK)
+                    for block in range(nblocks))
+
+
+def open_container(path, image: bytes, first_block: int = 0, chip: dict = CHIP):
+    "Write image to a container in one write() call and open it."
+    with NANDway3.ContainerWriter(str(path), PAGE, RAS, PAGES, chip["mf_id"],
+                                  chip["device_id"], first_block) as writer:
+        writer.write(image)
+    return NANDway3.open_image(str(path))
+
+
+def test_one_large_write_stores_every_block(tmp_path):
+    image = make_image(7) + os.urandom(100)
+    with open_container(tmp_path / "image.nwc", image) as container:
+        assert len(container.entries) == 8
+        assert len(container) == len(image)
+        assert container[:] == image
+        assert container[3*BLOCK + 5:5*BLOCK + 9] == image[3*BLOCK + 5:5*BLOCK + 9]
+    container = NANDway3.ImageContainer((tmp_path / "image.nwc").read_bytes())
+    NANDway3.unpack_image(container, str(tmp_path / "image.bin"))
+    assert (tmp_path / "image.bin").read_bytes() == image
+
+
+def test_mismatch_accepts_the_chip_it_was_made_for(tmp_path):
+    with open_container(tmp_path / "image.nwc", make_image(4)) as container:
+        assert container.mismatch(CHIP) == ""
+    unknown = dict(CHIP, mf_id=0, device_id=0)
+    with open_container(tmp_path / "anyid.nwc", make_image(4), chip=unknown) as container:
+        assert container.mismatch(CHIP) == ""
+
+
+def test_mismatch_refuses_other_chips_and_offset_dumps(tmp_path):
+    with open_container(tmp_path / "image.nwc", make_image(4)) as container:
+        assert "chip ec:75, not ad:dc" in container.mismatch(dict(CHIP, mf_id=0xAD, device_id=0xDC))
+        assert "pages" in container.mismatch(dict(CHIP, pages_per_block=2*PAGES))
+        assert "pages" in container.mismatch(dict(CHIP, ras=2*RAS))
+    with open_container(tmp_path / "offset.nwc", make_image(4), first_block=3) as container:
+        assert "block 0x3" in container.mismatch(CHIP)
@@ -0,0 +1,115 @@
+"Known-answer checks for the large-page and small-page ECC layouts."
+import os
+
+import pytest
+
+import NANDway3
+
+
+@pytest.fixture(params=["numpy", "python"])
+def ecc_backend(request, monkeypatch):
+    "Run a test with and without NumPy."
+    if request.param == "numpy":
+        if NANDway3.numpy is None:
+            pytest.skip("NumPy is not installed")
+    else:
+        monkeypatch.setattr(NANDway3, "numpy", None)
+    return request.param
+
+
+def large_page(data: bytes, ras: int = 64) -> bytes:
+    "A 2048-byte page with its ECC words at spare offset 0x30."
+    spare = bytearray(b"\xff" * ras)
+    for sector in range(4):
+        even, odd = NANDway3.sector_ecc(data[sector*512:(sector+1)*512])
+        spare[0x30 + 4*sector:0x34 + 4*sector] = bytes(
+            [even & 0xFF, even >> 8, odd & 0xFF, odd >> 8])
+    return data + bytes(spare)
+
+
+def small_page(data: bytes, codes=None) -> bytes:
+    "A 512-byte page with the SmartMedia ECC of its halves at spare 13 and 8."
+    spare = bytearray(b"\xff" * 16)
+    spare[13:16], spare[8:11] = codes or (smartmedia_ecc(data[:256]), smartmedia_ecc(data[256:]))
+    return data + bytes(spare)
+
+
+def smartmedia_ecc(data: bytes) -> bytes:
+    "The 3 ECC bytes of a 256-byte half, packed from sector_ecc()."
+    even, odd = NANDway3.sector_ecc(data)
+    lines = sum((((even >> (3 + bit)) & 1) << (2*bit)) | (((odd >> (3 + bit)) & 1) << (2*bit + 1))
+                for bit in range(8))
+    columns = sum((((even >> bit) & 1) << (2*bit)) | (((odd >> bit) & 1) << (2*bit + 1))
+                  for bit in range(3))
+    return bytes([~lines & 0xFF, ~lines >> 8 & 0xFF, (~columns << 2 | 3) & 0xFF])
+
+
+def test_large_page_known_answers():
+    assert NANDway3.sector_ecc(bytes(512)) == (0, 0)
+    # bit 0 of byte 0 is on every "clear" line, bit 7 of byte 0x1ff on every "set" one
+    assert NANDway3.sector_ecc(b"\x01" + bytes(511)) == (0xFFF, 0)
+    assert NANDway3.sector_ecc(bytes(511) + b"\x80") == (0, 0xFFF)
+    assert NANDway3.sector_ecc(bytes(0x123) + b"\x10" + bytes(0x1ff - 0x123)) == (
+        0xFFF ^ (0x123 << 3 | 4), 0x123 << 3 | 4)
+    assert NANDway3.stored_ecc(bytes([0xBC, 0x0A, 0x23, 0x01]), 512) == (0xABC, 0x123)
+    assert NANDway3.ecc_layout(2048, 64) == (512, (0x30, 0x34, 0x38, 0x3C))
+
+
+def test_small_page_known_answers():
+    # SmartMedia ECC bytes: ~LP7..LP0, ~LP15..LP8, ~CP5..CP0 followed by two 1 bits
+    assert NANDway3.stored_ecc(b"\xff\xff\xff", 256) == (0, 0)
+    assert NANDway3.stored_ecc(b"\xaa\xaa\xab", 256) == NANDway3.sector_ecc(b"\x01" + bytes(255))
+    assert NANDway3.stored_ecc(b"\x55\x55\x57", 256) == NANDway3.sector_ecc(bytes(255) + b"\x80")
+    assert NANDway3.sector_ecc(b"\x01" + bytes(255)) == (0x7FF, 0)
+    assert smartmedia_ecc(b"\x01" + bytes(255)) == b"\xaa\xaa\xab"
+    assert NANDway3.ecc_layout(512, 16) == (256, (13, 8))
+
+
+def test_ecc_layout_rejects_unknown_geometry():
+    with pytest.raises(ValueError):
+        NANDway3.ecc_layout(1024, 32)
+    with pytest.raises(ValueError):
+        NANDway3.ecc_layout(512, 16, 0x30)
+    with pytest.raises(ValueError):
+        NANDway3.ecc_layout(2048, 32)
+
+
+def test_large_page_check_and_correct(ecc_backend):
+    pages = [os.urandom(2048) for _ in range(6)]
+    image = bytearray(b"".join(large_page(data) for data in pages))
+    clean = NANDway3.check_ecc(image, 2048, 64)
+    assert clean["sectors"] == 24 and not clean["corrected"] + clean["uncorrectable"]
+
+    image[2*2112 + 700] ^= 0x10
+    image[4*2112 + 10] ^= 0x03
+    image[5*2112 + 2048 + 0x32] ^= 0x01
+    report = NANDway3.check_ecc(image, 2048, 64)
+    assert report["corrected"] == [(2, 1, 700, 4)]
+    assert report["uncorrectable"] == [(4, 0)]
+    assert report["ecc_errors"] == [(5, 0)]
+
+    NANDway3.correct_ecc(image, report, 2048, 64)
+    assert image[2*2112:3*2112] == large_page(pages[2])
+
+
+def test_small_page_check_and_correct(ecc_backend):
+    pages = [os.urandom(512) for _ in range(6)]
+    image = bytearray(b"".join(small_page(data) for data in pages))
+    clean = NANDway3.check_ecc(image, 512, 16)
+    assert clean["sectors"] == 12 and not clean["corrected"] + clean["uncorrectable"]
+
+    image[1*528 + 300] ^= 0x20
+    image[3*528 + 5] ^= 0x03
+    image[4*528 + 512 + 14] ^= 0x10
+    report = NANDway3.check_ecc(image, 512, 16)
+    assert report["corrected"] == [(1, 1, 300, 5)]
+    assert report["uncorrectable"] == [(3, 0)]
+    assert report["ecc_errors"] == [(4, 0)]
+
+    NANDway3.correct_ecc(image, report, 512, 16)
+    assert image[528:2*528] == small_page(pages[1])
+
+
+def test_erased_pages_are_skipped(ecc_backend):
+    report = NANDway3.check_ecc(b"\xff" * 528 * 4, 512, 16)
+    assert report["erased"] == 8 and report["sectors"] == 0
@@ -0,0 +1,77 @@
+"Whole-stack round trips against the firmware emulator, and replaying a capture of one."
+import os
+import threading
+
+import pytest
+
+import NANDway3
+import NANDway3_emu
+
+PAGE, RAS, PAGES, BLOCKS = 2048, 64, 64, 8
+BLOCK = (PAGE + RAS) * PAGES
+
+
+def make_image() -> bytes:
+    "Random blocks with every third one erased."
+    return b"".join(b"\xff" * BLOCK if block % 3 == 0 else os.urandom(BLOCK)
+                    for block in range(BLOCKS))
+
+
+def connect(port: str, transport=None, capture: str = "") -> NANDway3.NANDFlasher:
+    "A NANDFlasher for NAND0 behind port that has read the chip's ID."
+    flasher = NANDway3.NANDFlasher(port, 0, NANDway3.VERSION_MAJOR, NANDway3.VERSION_MINOR,
+                                   transport, capture)
+    flasher.progress = NANDway3.Progress("none")
+    flasher.ping()
+    flasher.readid()
+    return flasher
+
+
+@pytest.fixture
+def emulator(tmp_path):
+    "An erased emulated chip served on a pty by a background thread."
+    nand = NANDway3_emu.EmulatedNAND(str(tmp_path / "chip.bin"), PAGE, RAS, PAGES, BLOCKS,
+                                     0xEC, 0xF1)
+    teensy = NANDway3_emu.EmulatedTeensy([nand, None], NANDway3_emu.FaultInjector())
+    server = threading.Thread(target=NANDway3_emu.serve, args=([teensy],), daemon=True)
+    server.start()
+    yield teensy, tmp_path / "chip.bin"
+    # stop serving once the pty wakes serve() up, as BOOTLOADER would
+    teensy.running = False
+    os.write(teensy.slave, bytes((NANDway3.NANDFlasher.CMD_PING1,)))
+    server.join(5)
+
+
+def test_vwrite_then_dump_gives_back_the_image(emulator, tmp_path):
+    teensy, chip = emulator
+    image = make_image()
+    flasher = connect(teensy.name)
+    try:
+        assert flasher.program(image, True, 0, 0) == 0
+        flasher.dump(str(tmp_path / "dump.bin"), 0, 0)
+    finally:
+        flasher.close()
+    assert (tmp_path / "dump.bin").read_bytes() == image
+    assert chip.read_bytes() == image
+
+
+def test_replay_of_a_capture_dumps_the_same(emulator, tmp_path):
+    teensy, _ = emulator
+    image = make_image()
+    flasher = connect(teensy.name, capture=str(tmp_path / "trace.bin"))
+    try:
+        assert flasher.program(image, True, 0, 0) == 0
+        flasher.dump(str(tmp_path / "dump.bin"), 0, 0)
+    finally:
+        flasher.close()
+
+    replay = NANDway3.ReplaySerial(str(tmp_path / "trace.bin"))
+    flasher = connect(teensy.name, replay)
+    try:
+        assert flasher.program(image, True, 0, 0) == 0
+        flasher.dump(str(tmp_path / "replayed.bin"), 0, 0)
+    finally:
+        flasher.close()
+    assert (tmp_path / "replayed.bin").read_bytes() == image
+    assert replay.host_pos == len(replay.host)
+    assert replay.device_pos == len(replay.device)